@@ -0,0 +1,92 @@
+# (C) https://github.com/perfguru87/pgs-tools
+# Apache-2.0 license
+
+import math
+from array import array
+
+##############################################################################################################
+# HDR-style log-linear histogram: fixed memory, bounded relative error
+##############################################################################################################
+
+DEF_PRECISION_BITS = 6     # 64 sub-buckets per power of two, i.e. ~1.6% max relative error
+DEF_MAX_BITS = 32          # values up to 2^32 (~71 minutes in usec), larger values are clamped
+
+
+class Histogram:
+    """
+    Values below 2^precision_bits are counted exactly, each next power of two range
+    is split into 2^precision_bits equal sub-buckets, so the memory is fixed
+    regardless of the number of recorded values and the value spread.
+    """
+
+    def __init__(self, precision_bits=DEF_PRECISION_BITS, max_bits=DEF_MAX_BITS):
+        self.precision_bits = precision_bits
+        self.max_bits = max_bits
+        self.sub = 1 << precision_bits
+        self.max_value = (1 << max_bits) - 1
+        self.counts = array('I', [0]) * (self._index(self.max_value) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def _index(self, v):
+        if v < self.sub:
+            return v
+        shift = v.bit_length() - self.precision_bits - 1
+        return (shift << self.precision_bits) + (v >> shift)
+
+    def _highest(self, idx):
+        # highest value which falls into the given bucket
+        if idx < self.sub:
+            return idx
+        shift = (idx >> self.precision_bits) - 1
+        mant = (idx & (self.sub - 1)) + self.sub
+        return ((mant + 1) << shift) - 1
+
+    def record(self, v):
+        v = int(v)
+        if v < 0:
+            v = 0
+        elif v > self.max_value:
+            v = self.max_value
+        self.counts[self._index(v)] += 1
+        if not self.count or v < self.min:
+            self.min = v
+        if v > self.max:
+            self.max = v
+        self.count += 1
+        self.total += v
+
+    def merge(self, other):
+        if other.precision_bits != self.precision_bits or other.max_bits != self.max_bits:
+            raise ValueError("can't merge histograms with different layout")
+        if not other.count:
+            return self
+        for n in range(0, len(self.counts)):
+            if other.counts[n]:
+                self.counts[n] += other.counts[n]
+        if not self.count or other.min < self.min:
+            self.min = other.min
+        self.max = max(self.max, other.max)
+        self.count += other.count
+        self.total += other.total
+        return self
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        # rank of the value, 1-based
+        rank = max(1, int(math.ceil(p * self.count / 100.0)))
+        seen = 0
+        for n in range(0, len(self.counts)):
+            seen += self.counts[n]
+            if seen >= rank:
+                return min(self._highest(n), self.max)
+        return self.max
+
+    def percentiles(self, ps):
+        return [self.percentile(p) for p in ps]
@@ -30,5 +30,5 @@ setup(
         "License :: OSI Approved :: Apache Software License 2.0",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
 )
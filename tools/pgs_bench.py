@@ -6,54 +6,1018 @@
 import os
 import sys
 import time
+import math
+import random
+import string
+import itertools
 import logging
+import csv
+import io
+import json
+import socket
+import cProfile
+import pstats
+import datetime
+import configparser
+import psycopg2.extras
+from array import array
+import threading
+import multiprocessing
+from queue import Empty
 try:
     sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
     from pgs_db import DB
     from pgs_common import configure_logging
+    from pgs_hist import Histogram
 except ImportError:
     from pgs_tools.pgs_db import DB
     from pgs_tools.pgs_common import configure_logging
+    from pgs_tools.pgs_hist import Histogram
 
 ############# Begin of PostgreSQL benchmark code ###########
 
 
+BARRIER_TIMEOUT = 60
+MB = 1024 * 1024
+PERCENTILES = (50, 90, 99, 99.9)
+CLIENT_CPU_WARN = 90       # percent of a core used by a worker process
+PROFILE_TOP = 15
+PARTIAL_INTERVAL_MIN = 0.1  # shorter partial intervals have no rate, it would be noise
+
+
+class ClientResult:
+    def __init__(self, client_no, loops=0, begin=0, end=0, error=None, keep_intervals=False):
+        self.client_no = client_no
+        self.loops = loops
+        self.begin = begin
+        self.end = end
+        self.error = error
+
+        # aborted transactions by failure kind, e.g. {"deadlock": 3}
+        self.failures = {}
+
+        # client thread CPU time (sec) and --profile report
+        self.cpu = 0
+        self.profile = None
+
+        # operation latencies in usec, for the whole run and per time interval; the interval
+        # histograms are kept only if reported (-P, --timeseries), they cost ~14 KB each
+        self.hist = Histogram()
+        self.intervals = []
+        self.keep_intervals = keep_intervals
+
+        # open-loop mode: delay between the intended and the actual operation start, usec, and the number
+        # of operations due before the end but never sent (recorded with the latency up to the end)
+        self.lag = Histogram()
+        self.unsent = 0
+
+    def record(self, interval, usec):
+        if self.keep_intervals:
+            while len(self.intervals) <= interval:
+                self.intervals.append(Histogram())
+            self.intervals[interval].record(usec)
+        self.hist.record(usec)
+
+    def merge(self, other):
+        self.loops += other.loops
+        self.begin = min(self.begin, other.begin) if self.begin else other.begin
+        self.end = max(self.end, other.end)
+        self.hist.merge(other.hist)
+        self.lag.merge(other.lag)
+        self.cpu += other.cpu
+        self.unsent += other.unsent
+        for kind, n in other.failures.items():
+            self.failures[kind] = self.failures.get(kind, 0) + n
+        for n in range(0, len(other.intervals)):
+            if n >= len(self.intervals):
+                self.intervals.append(Histogram())
+            self.intervals[n].merge(other.intervals[n])
+        return self
+
+    def rate(self):
+        if self.end == self.begin:
+            return 0
+        return self.loops / (self.end - self.begin)
+
+
+def format_latency(h):
+    # usec histogram -> percentiles in ms
+    return ", ".join(["p%s %.3f" % (p, v / 1000.0) for p, v in zip(PERCENTILES, h.percentiles(PERCENTILES))] +
+                     ["max %.3f" % (h.max / 1000.0)])
+
+
+def _betacf(a, b, x):
+    # continued fraction for the incomplete beta function (Numerical Recipes, 6.4)
+    tiny = 1e-30
+    qab, qap, qam = a + b, a + 1.0, a - 1.0
+    c = 1.0
+    d = 1.0 - qab * x / qap
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 201):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1.0 + aa * d
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = 1.0 + aa / c
+        c = c if abs(c) > tiny else tiny
+        h *= d * c
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1.0 + aa * d
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = 1.0 + aa / c
+        c = c if abs(c) > tiny else tiny
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < 1e-12:
+            break
+    return h
+
+
+def _betai(a, b, x):
+    # regularized incomplete beta function I_x(a, b)
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    bt = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log(1.0 - x))
+    if x < (a + 1.0) / (a + b + 2.0):
+        return bt * _betacf(a, b, x) / a
+    return 1.0 - bt * _betacf(b, a, 1.0 - x) / b
+
+
+def student_t_pvalue(t, df):
+    # two-sided p-value of the Student's t statistic
+    return _betai(df / 2.0, 0.5, df / (df + t * t))
+
+
+def student_t_critical(alpha, df):
+    # t such that the two-sided p-value is alpha
+    lo, hi = 0.0, 1000.0
+    for i in range(0, 100):
+        mid = (lo + hi) / 2
+        if student_t_pvalue(mid, df) > alpha:
+            lo = mid
+        else:
+            hi = mid
+    return hi
+
+
+def mean_stddev(vals):
+    n = len(vals)
+    mean = sum(vals) / float(n)
+    if n < 2:
+        return mean, 0.0
+    return mean, math.sqrt(sum([(v - mean) ** 2 for v in vals]) / (n - 1))
+
+
+class Baseline:
+    """
+    Results of a pgs-bench run with host/server/config fingerprints, saved as JSON:
+
+        {"format": 1, "time": ..., "fingerprint": {...}, "config": {...},
+         "results": {TESTCASE: {"metrics": "selects/sec", "runs": [{"score": N, "latency_us": {...}}, ...]}}}
+    """
+
+    FORMAT = 1
+    SETTINGS = ("shared_buffers", "effective_cache_size", "work_mem", "max_connections", "fsync",
+                "synchronous_commit", "wal_level", "full_page_writes", "checkpoint_timeout", "max_wal_size",
+                "huge_pages", "ssl")
+
+    def __init__(self, data=None):
+        self.data = data if data else {"format": self.FORMAT, "results": {}}
+
+    @staticmethod
+    def load(fname):
+        with open(fname) as f:
+            data = json.load(f)
+        if data.get("format") != Baseline.FORMAT:
+            raise ValueError("%s: unsupported baseline format" % fname)
+        return Baseline(data)
+
+    def save(self, fname):
+        with open(fname, "w") as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+
+    def collect(self, con, config):
+        uname = os.uname()
+        fp = {
+            "client_host": socket.gethostname(),
+            "client_kernel": "%s %s %s" % (uname[0], uname[2], uname[4]),
+            "server_version": DB.execute_fetchval(con, "SELECT version()"),
+            "server_addr": str(DB.execute_fetchval(con, "SELECT inet_server_addr()")),
+            "settings": dict(DB.execute_fetchall(con, "SELECT name, current_setting(name) FROM pg_settings "
+                                                      "WHERE name IN (%s)" %
+                                                      ", ".join(["'%s'" % n for n in self.SETTINGS]))),
+        }
+        try:
+            fp["system_identifier"] = str(DB.execute_fetchval(con, "SELECT system_identifier FROM pg_control_system()"))
+        except psycopg2.Error:
+            pass  # PostgreSQL < 9.6 or not enough privileges
+        self.data["time"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.data["fingerprint"] = fp
+        self.data["config"] = config
+
+    def add(self, testcase, metrics, run):
+        r = self.data["results"].setdefault(testcase, {"metrics": metrics, "runs": []})
+        r["runs"].append(run)
+
+    def scores(self, testcase):
+        r = self.data["results"].get(testcase)
+        return [run["score"] for run in r["runs"]] if r else []
+
+    def fingerprint_diff(self, other):
+        def flatten(d, prefix=""):
+            ret = {}
+            for k, v in d.items():
+                if isinstance(v, dict):
+                    ret.update(flatten(v, prefix + k + "."))
+                else:
+                    ret[prefix + k] = v
+            return ret
+
+        ret = []
+        for section in ("fingerprint", "config"):
+            old = flatten(other.data.get(section, {}), section + ".")
+            new = flatten(self.data.get(section, {}), section + ".")
+            for k in sorted(set(old) | set(new)):
+                if old.get(k) != new.get(k):
+                    ret.append("%s: %s -> %s" % (k, old.get(k), new.get(k)))
+        return ret
+
+    def compare(self, baseline, alpha, tolerance):
+        """
+        Welch's t-test of the scores of every testcase present in both runs (higher score is better),
+        returns report lines and the number of regressions
+        """
+        ret = ["", "Comparison with the baseline taken at %s:" % baseline.data.get("time")]
+        for diff in self.fingerprint_diff(baseline):
+            ret.append("  changed %s" % diff)
+        ret.append("")
+        ret.append("  %-32s %24s %24s %8s  %s" % ("TESTCASE", "BASELINE (95% CI)", "CURRENT (95% CI)", "CHANGE",
+                                                 "VERDICT"))
+        regressions = 0
+
+        def ci(vals):
+            mean, sd = mean_stddev(vals)
+            if len(vals) < 2:
+                return mean, sd, "%d (n=1)" % mean
+            half = student_t_critical(0.05, len(vals) - 1) * sd / math.sqrt(len(vals))
+            return mean, sd, "%d +- %d (n=%d)" % (mean, half, len(vals))
+
+        for testcase in self.data["results"]:
+            old = baseline.scores(testcase)
+            new = self.scores(testcase)
+            if not old or not new:
+                continue
+            m1, s1, ci1 = ci(old)
+            m2, s2, ci2 = ci(new)
+            change = 100.0 * (m2 - m1) / m1 if m1 else 0
+
+            if len(old) < 2 or len(new) < 2:
+                verdict = "n/a (use --repeat >= 2)"
+            else:
+                se = math.sqrt(s1 * s1 / len(old) + s2 * s2 / len(new))
+                if not se:
+                    p = 0.0 if m1 != m2 else 1.0
+                else:
+                    t = (m2 - m1) / se
+                    # Welch-Satterthwaite degrees of freedom
+                    df = se ** 4 / ((s1 * s1 / len(old)) ** 2 / (len(old) - 1) +
+                                    (s2 * s2 / len(new)) ** 2 / (len(new) - 1))
+                    p = student_t_pvalue(t, df)
+                if p < alpha and change < -tolerance:
+                    verdict = "REGRESSION (p=%.3f)" % p
+                    regressions += 1
+                elif p < alpha and change > tolerance:
+                    verdict = "IMPROVEMENT (p=%.3f)" % p
+                else:
+                    verdict = "no significant change (p=%.3f)" % p
+            ret.append("  %-32s %24s %24s %+7.1f%%  %s" % (testcase, ci1, ci2, change, verdict))
+        return ret, regressions
+
+
+class ServerStatsSampler(threading.Thread):
+    """
+    Samples background writer/checkpointer, WAL and autovacuum activity on a side connection
+    every 'interval' seconds while the test is running
+    """
+
+    COLS = ("checkpoints", "buffers_checkpoint", "buffers_clean", "buffers_backend", "wal_bytes",
+            "autovacuum_workers")
+    GAUGES = ("autovacuum_workers",)
+
+    def __init__(self, db, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.db = db
+        self.interval = interval
+        self.samples = []
+        self.stop_event = threading.Event()
+        self.con = db.connect()
+
+        if db.vermajor_a >= 17:
+            self.queries = ["SELECT num_timed + num_requested AS checkpoints, buffers_written AS buffers_checkpoint "
+                            "FROM pg_stat_checkpointer",
+                            "SELECT buffers_clean FROM pg_stat_bgwriter"]
+        else:
+            self.queries = ["SELECT checkpoints_timed + checkpoints_req AS checkpoints, buffers_checkpoint, "
+                            "buffers_clean, buffers_backend FROM pg_stat_bgwriter"]
+        if db.vermajor_a >= 10:
+            self.queries += ["SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')::bigint AS wal_bytes",
+                             "SELECT COUNT(*) AS autovacuum_workers FROM pg_stat_activity "
+                             "WHERE backend_type = 'autovacuum worker'"]
+
+    def sample(self):
+        ret = {}
+        for q in self.queries:
+            try:
+                ret.update(DB.execute_fetch(self.con, q, lambda cur: dict(zip([d[0] for d in cur.description],
+                                                                              cur.fetchone()))))
+            except psycopg2.Error as e:
+                logging.debug("server stats sampling failed: %s" % str(e))  # e.g. WAL position on a replica
+        self.samples.append((time.time(), ret))
+
+    def run(self):
+        next_t = time.time()
+        while not self.stop_event.is_set():
+            self.sample()
+            next_t += self.interval
+            self.stop_event.wait(max(0, next_t - time.time()))
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        self.sample()
+        self.con.close()
+
+    def _nearest(self, t):
+        return min(self.samples, key=lambda s: abs(s[0] - t))[1]
+
+    def delta(self, begin, end):
+        # counters delta between the samples nearest to the given times, gauges at the end
+        old = self._nearest(begin)
+        new = self._nearest(end)
+        ret = {}
+        for c in self.COLS:
+            if c not in new:
+                continue
+            if c in self.GAUGES:
+                ret[c] = new[c]
+            elif c in old:
+                ret[c] = new[c] - old[c]
+        return ret
+
+
+class TimeSeriesWriter:
+    """
+    Per-interval throughput/latency (and server stats) samples in CSV or NDJSON format
+    """
+
+    COLS = ["testcase", "run", "loop", "time", "interval", "duration_s", "ops", "ops_per_sec",
+            "p50_ms", "p90_ms", "p99_ms", "p99.9_ms", "max_ms"]
+
+    def __init__(self, fname, fmt=None, server_stats=False):
+        self.fmt = fmt if fmt else ("csv" if fname.endswith(".csv") else "ndjson")
+        self.f = open(fname, "w")
+        self.cols = self.COLS + (list(ServerStatsSampler.COLS) if server_stats else [])
+        if self.fmt == "csv":
+            self.csv = csv.DictWriter(self.f, self.cols, extrasaction="ignore")
+            self.csv.writeheader()
+
+    def write(self, row):
+        if self.fmt == "csv":
+            self.csv.writerow(row)
+        else:
+            self.f.write(json.dumps(row, sort_keys=True) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class ParamGenerator:
+    """
+    Generates a batch of parameter values at once, see Workload for the supported types
+    """
+
+    def __init__(self, name, section):
+        self.name = name
+        self.type = section.get("type", "uniform")
+
+        if self.type in ("uniform", "zipfian"):
+            self.min = section.getint("min", 1)
+            self.max = section.getint("max")
+            if self.max is None or self.max < self.min:
+                raise ValueError("param '%s': 'max' must be set and be >= 'min'" % name)
+            self.keys = range(self.min, self.max + 1)
+            if self.type == "zipfian":
+                # P(k) ~ 1 / rank^skew, the cumulative weights are precomputed once (8 bytes per key)
+                skew = section.getfloat("skew", 0.99)
+                self.cum_weights = array('d', itertools.accumulate([1.0 / (n ** skew)
+                                                                    for n in range(1, len(self.keys) + 1)]))
+        elif self.type == "string":
+            self.length = section.getint("length", 16)
+            self.chars = section.get("chars", string.ascii_letters + string.digits)
+        else:
+            raise ValueError("param '%s': unknown type '%s'" % (name, self.type))
+
+    def batch(self, n):
+        if self.type == "uniform":
+            return random.choices(self.keys, k=n)
+        if self.type == "zipfian":
+            return random.choices(self.keys, cum_weights=self.cum_weights, k=n)
+        s = "".join(random.choices(self.chars, k=n * self.length))
+        return [s[i:i + self.length] for i in range(0, n * self.length, self.length)]
+
+
+class Workload:
+    """
+    Workload definition file (INI format):
+
+        [workload]
+        name = accounts                 ; testcase name is 'workload_accounts'
+        description = 90% reads, 10% updates
+        setup = CREATE TABLE ...        ; SQL executed before the test (multi-line values are indented)
+        teardown = DROP TABLE ...       ; SQL executed after the test
+        minscore = 1000                 ; expected minimal transactions/sec
+
+        [param aid]                     ; referenced as %(aid)s in the transactions SQL
+        type = zipfian                  ; uniform (min, max), zipfian (min, max, skew), string (length, chars)
+        min = 1
+        max = 100000
+        skew = 0.99
+
+        [txn select]
+        weight = 90                     ; relative frequency of the transaction
+        sql = SELECT abalance FROM accounts WHERE aid = %(aid)s
+    """
+
+    def __init__(self, fname):
+        cfg = configparser.ConfigParser(interpolation=None, inline_comment_prefixes=(";",))
+        if not cfg.read(fname):
+            raise ValueError("can't read workload file '%s'" % fname)
+        if not cfg.has_section("workload"):
+            raise ValueError("%s: [workload] section is missing" % fname)
+
+        w = cfg["workload"]
+        self.name = w.get("name", os.path.splitext(os.path.basename(fname))[0])
+        self.description = w.get("description", "workload '%s'" % self.name)
+        self.setup = w.get("setup")
+        self.teardown = w.get("teardown")
+        self.minscore = w.getint("minscore", 1000)
+
+        self.params = []
+        self.txns = []
+        weights = []
+        for section in cfg.sections():
+            if section.startswith("param "):
+                self.params.append(ParamGenerator(section[6:].strip(), cfg[section]))
+            elif section.startswith("txn "):
+                if not cfg[section].get("sql"):
+                    raise ValueError("%s: [%s] has no 'sql'" % (fname, section))
+                self.txns.append(cfg[section]["sql"])
+                weights.append(cfg[section].getfloat("weight", 1))
+
+        if not self.txns:
+            raise ValueError("%s: no [txn ...] sections" % fname)
+        self.cum_weights = list(itertools.accumulate(weights))
+        self.names = [p.name for p in self.params]
+
+    def batch(self, n):
+        txns = random.choices(self.txns, cum_weights=self.cum_weights, k=n)
+        if not self.params:
+            return [(sql, None) for sql in txns]
+        args = [dict(zip(self.names, vals)) for vals in zip(*[p.batch(n) for p in self.params])]
+        return list(zip(txns, args))
+
+
+class CopyStream:
+    """
+    File-like object feeding COPY FROM STDIN with the given lines (any iterable),
+    or with the lines repeated until 'rows' lines are produced if 'rows' is given,
+    nothing is materialized in memory
+    """
+
+    def __init__(self, lines, rows=None):
+        if rows is None:
+            self.lines = iter(lines)
+        else:
+            self.lines = itertools.islice(itertools.cycle(lines), rows)
+
+    def read(self, size=-1):
+        buf = []
+        n = 0
+        for line in self.lines:
+            buf.append(line)
+            n += len(line)
+            if size > 0 and n >= size:
+                break
+        return "".join(buf)
+
+
+class KeyedQuery:
+    """
+    Query looking up random keys, executed in one of the modes:
+        simple   - the key is inlined into the query text, so every query is parsed and planned
+        params   - the key is passed as a parameter (psycopg2 interpolates it on the client side)
+        prepared - the query is PREPARE-d once per connection and run by EXECUTE
+    """
+
+    def __init__(self, sql, keys, mode):
+        self.sql = sql
+        self.keys = keys
+        self.mode = mode
+        self.name = "pgs_bench_%d" % id(self)
+
+    def setup(self, cur):
+        if self.mode == "prepared":
+            cur.execute("PREPARE %s (integer) AS %s" % (self.name, self.sql.replace("%s", "$1")))
+
+    def teardown(self, cur):
+        if self.mode == "prepared":
+            cur.execute("DEALLOCATE %s" % self.name)
+
+    def batch(self, n):
+        keys = random.choices(self.keys, k=n)
+        if self.mode == "simple":
+            return [(self.sql % k, None) for k in keys]
+        if self.mode == "params":
+            return [(self.sql, (k,)) for k in keys]
+        return [("EXECUTE %s (%%s)" % self.name, (k,)) for k in keys]
+
+
+class ContendedQuery:
+    """
+    Transaction touching 'nkeys' random rows out of a small hot set (referenced as
+    %(k1)s, %(k2)s, ... in the SQL), the transactions aborted by deadlocks,
+    serialization failures or lock timeouts are rolled back and counted
+    """
+
+    count_failures = True
+
+    def __init__(self, sql, keys=None, nkeys=0):
+        self.sql = sql
+        self.keys = keys
+        self.names = ["k%d" % (n + 1) for n in range(0, nkeys)]
+
+    def batch(self, n):
+        if not self.names:
+            return [(self.sql, None)] * n
+        return [(self.sql, dict(zip(self.names, random.choices(self.keys, k=len(self.names)))))
+                for i in range(0, n)]
+
+
+class ConnectOp:
+    """
+    Connection establishment as a benchmark operation:
+        raw       - psycopg2.connect() + close() with given sslmode
+        reconnect - DBConnection.reconnect() of a per-client connection (honors --db-ssl)
+    """
+
+    def __init__(self, db, method, sslmode=None):
+        self.db = db
+        self.method = method
+        self.local = threading.local()
+
+        loc = db.loc
+        self.dsn = "host=%s port=%s dbname=%s user=%s password=%s application_name=pgs_bench_connect" % \
+                   (loc.db_host, loc.db_port, loc.db_name, loc.db_user, loc.db_pass)
+        if sslmode:
+            self.dsn += " sslmode=%s" % sslmode
+
+    def setup(self, cur):
+        if self.method == "reconnect":
+            self.local.con = self.db.connect(fatal_error_cb=PgBench._fatal_error, reconnect_attempts=1)
+
+    def teardown(self, cur):
+        if self.method == "reconnect":
+            self.local.con.close()
+
+    def batch(self, n):
+        return [(self.method, None)] * n
+
+    def execute(self, sql, args):
+        if self.method == "reconnect":
+            self.local.con.reconnect()
+        else:
+            psycopg2.connect(self.dsn).close()
+
+
+TESTCASES = ["sequential_select", "sequential_commit",
+             "bulk_insert", "bulk_multirow_values", "bulk_execute_values", "bulk_copy",
+             "protocol_point_select", "protocol_join_select", "read_scaling",
+             "contention_hot_update", "contention_hot_update_rr", "contention_advisory_lock",
+             "contention_queue_for_update", "contention_queue_skip_locked",
+             "connect_raw", "connect_raw_ssl", "connect_reconnect"]
+DEF_BATCH_SIZES = "10,100,1000,10000"
+DEF_ROW_SIZE = 100
+BULK_TABLE = "postgresql_bulk_benchmark"
+
+ACCOUNTS_TABLE = "postgresql_bench_accounts"
+BRANCHES_TABLE = "postgresql_bench_branches"
+ROWS_PER_SCALE = 100000
+DEF_SCALE = 10
+DEF_DATASET_ROWS = ROWS_PER_SCALE
+ACCOUNTS_PER_BRANCH = 1000
+PROTOCOL_MODES = ("simple", "params", "prepared")
+RANGE_ROWS = 100
+HOT_TABLE = "postgresql_hot_rows_benchmark"
+QUEUE_TABLE = "postgresql_queue_benchmark"
+DEF_HOT_ROWS = 10
+QUEUE_JOBS = 10000
+FAILURES = {"40P01": "deadlock", "40001": "serialization failure", "55P03": "lock not available"}
+TRANSFER_SQL = "UPDATE %s SET balance = balance - 1 WHERE id = %%(k1)s; " \
+               "UPDATE %s SET balance = balance + 1 WHERE id = %%(k2)s; COMMIT" % (HOT_TABLE, HOT_TABLE)
+DEQUEUE_SQL = "WITH job AS (DELETE FROM %s WHERE id = (SELECT id FROM %s ORDER BY id LIMIT 1 %%s) " \
+              "RETURNING payload) INSERT INTO %s (payload) SELECT payload FROM job" % \
+              (QUEUE_TABLE, QUEUE_TABLE, QUEUE_TABLE)
+READ_SCALING_QUERIES = [
+    ("point", "SELECT abalance FROM %s WHERE aid = %%s" % ACCOUNTS_TABLE),
+    ("range", "SELECT abalance FROM %s WHERE aid >= %%s ORDER BY aid LIMIT %d" % (ACCOUNTS_TABLE, RANGE_ROWS)),
+    ("index-only", "SELECT aid FROM %s WHERE aid >= %%s ORDER BY aid LIMIT %d" % (ACCOUNTS_TABLE, RANGE_ROWS)),
+]
+
+
 class PgBench:
-    def __init__(self, con):
+    def __init__(self, con, db=None, clients=1, jobs=1, rate=0, batch_sizes=None, row_size=DEF_ROW_SIZE,
+                 pooler=None, interval=1.0, timeseries=None, server_stats=False, scale=DEF_SCALE,
+                 working_sets=None, keep_dataset=False, hot_rows=DEF_HOT_ROWS, profile=False):
         self.con = con
+        self.db = db
+        self.pooler = pooler
+        self.interval = interval
+        self.timeseries = timeseries
+        self.server_stats = server_stats
+        self.testcase = None
+        self.run = 0
+        self.loop_no = 0
+        self.clients = clients
+        self.jobs = jobs
+        self.rate = rate
+        self.batch_sizes = batch_sizes if batch_sizes else [int(b) for b in DEF_BATCH_SIZES.split(",")]
+        self.row_size = row_size
+        self.scale = scale
+        self.working_sets = working_sets
+        self.keep_dataset = keep_dataset
+        self.hot_rows = hot_rows
+        self.profile = profile
+        self.results = []
+        self.reports = []
+        self.per_second = False
+        self._total = None
+        self._total_of = None
 
-    def _loop(self, timeout, query, chunk=None):
-        if not chunk:
-            chunk = 100
+    def _client_loop(self, con, timeout, query, chunk, client_no=0):
+        res = ClientResult(client_no, keep_intervals=self.per_second or self.timeseries is not None)
+
+        if isinstance(query, str):
+            batch = [(query, None)] * chunk
+            next_batch = lambda n: batch
+        else:
+            next_batch = query.batch
+
+        cur = con.cursor()
+
+        # per-connection preparations, e.g. PREPARE statements
+        if hasattr(query, "setup"):
+            query.setup(cur)
+
+        # the operation is either a SQL statement or a custom action, e.g. connection establishment
+        execute = query.execute if hasattr(query, "execute") else cur.execute
+        if getattr(query, "count_failures", False):
+            execute = self._counting_failures(execute, cur, res)
+
+        # only one client per run is profiled: profilers are per-thread (or exclusive since python 3.12)
+        prof = None
+        if self.profile and client_no == 0:
+            prof = cProfile.Profile()
+            prof.enable()
+        cpu = time.thread_time()
+
+        if self.rate:
+            res = self._client_open_loop(res, execute, timeout, next_batch, chunk)
+        else:
+            res = self._client_closed_loop(res, execute, timeout, next_batch, chunk)
+
+        res.cpu = time.thread_time() - cpu
+        if prof:
+            prof.disable()
+            out = io.StringIO()
+            pstats.Stats(prof, stream=out).strip_dirs().sort_stats("tottime").print_stats(PROFILE_TOP)
+            res.profile = out.getvalue()
+
+        if hasattr(query, "teardown"):
+            query.teardown(cur)
+        return res
+
+    @staticmethod
+    def _counting_failures(execute, cur, res):
+        def _execute(sql, args):
+            try:
+                execute(sql, args)
+            except psycopg2.Error as e:
+                kind = FAILURES.get(e.pgcode)
+                if not kind:
+                    raise
+                cur.execute("ROLLBACK")
+                res.failures[kind] = res.failures.get(kind, 0) + 1
+        return _execute
+
+    def _client_closed_loop(self, res, execute, timeout, next_batch, chunk):
+        perf = time.perf_counter
+        ratio = 1.0 / self.interval
         begin = time.time()
         end = begin + timeout
+        pbegin = perf()
         loops = 0
-
-        cur = self.con.cursor()
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
 
         while time.time() < end:
-            for i in range(0, chunk):
-                logging.debug(query)
-                cur.execute(query)
+            for sql, args in next_batch(chunk):
+                if debug:
+                    logging.debug(sql)
+                t = perf()
+                execute(sql, args)
+                done = perf()
+                res.record(int((done - pbegin) * ratio), (done - t) * 1000000)
             loops += chunk
 
-        end = time.time()
+        res.loops = loops
+        res.begin = begin
+        res.end = time.time()
+        return res
+
+    def _client_open_loop(self, res, execute, timeout, next_batch, chunk):
+        # operations are started on a fixed timeline regardless of the server response time,
+        # the clients timelines are interleaved, so the total arrival rate is self.rate
+        perf = time.perf_counter
+        ratio = 1.0 / self.interval
+        begin = time.time()
+        pbegin = perf()
+        period = self.clients / float(self.rate)
+        intended = pbegin + res.client_no / float(self.rate)
+        pend = pbegin + timeout
+        loops = 0
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+        now = perf()
+        while intended < pend and now < pend:
+            for sql, args in next_batch(chunk):
+                now = perf()
+                if intended >= pend or now >= pend:
+                    break
+                if intended > now:
+                    time.sleep(intended - now)
+                    now = perf()
+                if debug:
+                    logging.debug(sql)
+                execute(sql, args)
+                done = perf()
+                # latency is measured from the intended start to avoid coordinated omission
+                res.record(int((done - pbegin) * ratio), (done - intended) * 1000000)
+                res.lag.record((now - intended) * 1000000)
+                intended += period
+                loops += 1
+
+        # the operations due before the end which a stalled client never sent still count, as if
+        # they completed right now, otherwise a stall at the end would be hidden again
+        done = perf()
+        interval = int((done - pbegin) * ratio)
+        while intended < pend:
+            res.record(interval, (done - intended) * 1000000)
+            res.unsent += 1
+            intended += period
+
+        res.loops = loops
+        res.begin = begin
+        res.end = time.time()
+        return res
+
+    @staticmethod
+    def _fatal_error(msg):
+        # the default callback calls sys.exit(), the client must report its failure instead
+        raise RuntimeError(msg)
+
+    def _client(self, client_no, timeout, query, chunk, barrier, queue):
+        con = None
+        try:
+            con = self.db.connect(fatal_error_cb=self._fatal_error)
+            barrier.wait(BARRIER_TIMEOUT)
+            res = self._client_loop(con, timeout, query, chunk, client_no)
+        except Exception as e:
+            barrier.abort()
+            res = ClientResult(client_no, error="%s: %s" % (type(e).__name__, str(e)))
+        if con:
+            con.close()
+        queue.put(res)
+
+    def _job(self, client_nos, timeout, query, chunk, barrier, queue):
+        threads = []
+        for client_no in client_nos:
+            t = threading.Thread(target=self._client, args=(client_no, timeout, query, chunk, barrier, queue))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+    def _run_clients(self, timeout, query, chunk):
+        # fork: the worker processes inherit the bench object, no pickling of the testcase state is needed
+        ctx = multiprocessing.get_context("fork")
+        barrier = ctx.Barrier(self.clients)
+        queue = ctx.Queue()
+        jobs = max(1, min(self.jobs, self.clients))
+
+        procs = []
+        for j in range(0, jobs):
+            p = ctx.Process(target=self._job, args=(list(range(j, self.clients, jobs)), timeout, query, chunk,
+                                                    barrier, queue))
+            p.start()
+            procs.append(p)
+
+        results = []
+        try:
+            for n in range(0, self.clients):
+                results.append(queue.get(True, timeout + 2 * BARRIER_TIMEOUT))
+        except Empty:
+            for p in procs:
+                p.terminate()
+            missing = sorted(set(range(0, self.clients)) - set([r.client_no for r in results]))
+            raise RuntimeError("client(s) #%s didn't report the result, %d of %d clients finished" %
+                               (", #".join([str(n) for n in missing]), len(results), self.clients))
+        for p in procs:
+            p.join()
+
+        for r in results:
+            if r.error:
+                raise RuntimeError("client #%d failed: %s" % (r.client_no, r.error))
+        return sorted(results, key=lambda r: r.client_no)
+
+    def _loop(self, timeout, query, chunk=None):
+        if not chunk:
+            chunk = 100
+
+        sampler = None
+        if self.server_stats:
+            sampler = ServerStatsSampler(self.db, self.interval)
+            sampler.start()
+
+        try:
+            if self.clients > 1:
+                self.results = self._run_clients(timeout, query, chunk)
+            else:
+                self.results = [self._client_loop(self.con, timeout, query, chunk)]
+        finally:
+            if sampler:
+                sampler.stop()
+
+        if self.timeseries:
+            self.write_timeseries(sampler)
+        self.loop_no += 1
+
+        report = self.cpu_report()
+        if report:
+            self.reports.append(report)
+
+        begin = min([r.begin for r in self.results])
+        end = max([r.end for r in self.results])
         if end == begin:
             return 0
-        return int(loops / (end - begin))
+        return int(sum([r.loops for r in self.results]) / (end - begin))
+
+    def interval_duration(self, total, n):
+        # the last interval is usually partial: the clients finish their last chunk after --testtime
+        return max(0, min(self.interval, total.end - (total.begin + n * self.interval)))
+
+    def interval_rate(self, h, duration):
+        # None for a too short partial interval, its rate would be noise
+        if duration < self.interval * PARTIAL_INTERVAL_MIN:
+            return None
+        return h.count / duration
+
+    def write_timeseries(self, sampler):
+        total = self.total()
+        for n in range(0, len(total.intervals)):
+            h = total.intervals[n]
+            t = total.begin + n * self.interval
+            duration = self.interval_duration(total, n)
+            row = {"testcase": self.testcase, "run": self.run, "loop": self.loop_no,
+                   "time": datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+                   "interval": n, "duration_s": round(duration, 3), "ops": h.count,
+                   "max_ms": h.max / 1000.0}
+            rate = self.interval_rate(h, duration)
+            row["ops_per_sec"] = round(rate, 1) if rate is not None else None
+            for p, v in zip(PERCENTILES, h.percentiles(PERCENTILES)):
+                row["p%s_ms" % p] = v / 1000.0
+            if sampler:
+                row.update(sampler.delta(t, t + duration))
+            self.timeseries.write(row)
+
+    def total(self):
+        # merged once per loop: the results list is replaced by every loop, never modified
+        if self._total_of is not self.results:
+            total = ClientResult(0)
+            for r in self.results:
+                total.merge(r)
+            self._total, self._total_of = total, self.results
+        return self._total
+
+    def latency_report(self, per_second=False):
+        if not self.results:
+            return None
+        total = self.total()
+
+        ret = "latency (ms): %s" % format_latency(total.hist)
+        if self.rate:
+            ret += "\n    open-loop target %d ops/sec, schedule lag (ms): %s" % (self.rate, format_latency(total.lag))
+            if total.unsent:
+                ret += "\n    %d ops due before the end were not sent, counted with the latency up to the end" % \
+                    total.unsent
+        if per_second:
+            for n in range(0, len(total.intervals)):
+                h = total.intervals[n]
+                duration = self.interval_duration(total, n)
+                rate = self.interval_rate(h, duration)
+                ret += "\n      %6.1fs: %7d ops, %8s ops/sec, %s%s" % \
+                    (n * self.interval, h.count, "%.1f" % rate if rate is not None else "-", format_latency(h),
+                     (" (partial %.2fs)" % duration) if duration < self.interval else "")
+        return ret
+
+    def cpu_report(self):
+        # the client threads of a worker process share one core (GIL), so a busy process limits the result
+        jobs = max(1, min(self.jobs, self.clients)) if self.clients > 1 else 1
+        begin = min([r.begin for r in self.results])
+        end = max([r.end for r in self.results])
+        if end == begin:
+            return None
+        busiest = max([sum([r.cpu for r in self.results if r.client_no % jobs == j]) for j in range(0, jobs)])
+        busiest = 100.0 * busiest / (end - begin)
+
+        ret = None
+        if self.profile:
+            total = self.total()
+            ret = "client CPU: %.1f usec/op, busiest worker process %.0f%% of a core" % \
+                (1000000.0 * total.cpu / total.loops if total.loops else 0, busiest)
+            for r in self.results:
+                if r.profile:
+                    ret += "\n      client #%d profile:\n" % r.client_no + \
+                           "\n".join([("      " + l).rstrip() for l in r.profile.strip().splitlines()])
+        if busiest > CLIENT_CPU_WARN:
+            ret = (ret + "\n    " if ret else "") + \
+                "WARNING: a client worker process uses %.0f%% of a core, the result is likely client-bound, " \
+                "spread the clients over more --jobs" % busiest
+        return ret
 
-    def test(self, testcase, timeout=5, minscore=None, chunk=None):
+    def fairness_report(self):
+        if len(self.results) < 2:
+            return None
+        rates = [r.rate() for r in self.results]
+        n = len(rates)
+        avg = sum(rates) / n
+        stddev = math.sqrt(sum([(r - avg) ** 2 for r in rates]) / n)
+        sq = sum([r * r for r in rates])
+        jain = (sum(rates) ** 2) / (n * sq) if sq else 1.0
+        return "%d clients/%d jobs, per client ops/sec: min %d, avg %d, max %d, stddev %.1f%%, Jain's fairness %.3f" % \
+            (n, max(1, min(self.jobs, self.clients)), min(rates), avg, max(rates),
+             100.0 * stddev / avg if avg else 0, jain)
+
+    def summary(self):
+        ret = {"score": self.score}
+        if self.results:
+            h = self.total().hist
+            ret["latency_us"] = dict([("p%s" % p, v) for p, v in zip(PERCENTILES, h.percentiles(PERCENTILES))] +
+                                     [("max", h.max), ("mean", h.mean())])
+            failures = self.total().failures
+            if failures:
+                ret["failures"] = failures
+        return ret
+
+    def test(self, testcase, timeout=5, minscore=None, chunk=None, per_second=False, run=0):
+        self.results = []
+        self.reports = []
+        self.testcase = testcase
+        self.run = run
+        self.per_second = per_second
+        self.loop_no = 0
         score, minscore, msg, metrics = getattr(self, testcase)(timeout, minscore, chunk)
+        self.score = score
+        self.metrics = metrics
 
         ret = "%-50s: %5d %s" % (msg, score, metrics)
         ret = "%65s - should be > %d, " % (ret, minscore)
         if score < minscore / 4:
-            return False, ret + "VERY SLOW"
-        if score < minscore:
-            return False, ret + "SLOW"
-        if score > minscore * 2:
-            return True, ret + "VERY GOOD"
-        return True, ret + "GOOD"
+            status, ret = False, ret + "VERY SLOW"
+        elif score < minscore:
+            status, ret = False, ret + "SLOW"
+        elif score > minscore * 2:
+            status, ret = True, ret + "VERY GOOD"
+        else:
+            status, ret = True, ret + "GOOD"
+
+        for report in self.reports + [self.latency_report(per_second), self.fairness_report()]:
+            if report:
+                ret += "\n    %s" % report
+        return status, ret
 
     def sequential_select(self, timeout, minscore, chunk):
         if not minscore:
@@ -77,6 +1041,388 @@ class PgBench:
 
         return rate, minscore, "sequential commit test 'BEGIN; INSERT ...; COMMIT'", "commits/sec"
 
+    def _bulk(self, timeout, minscore, load):
+        # runs load(cur, rows, lines, batch) in a loop for every batch size, returns the best rows/sec
+        if not minscore:
+            minscore = 10000
+        cur = self.con.cursor()
+        payload = 'a' * self.row_size
+        best = 0
+
+        cur.execute("DROP TABLE IF EXISTS %s" % BULK_TABLE)
+        cur.execute("CREATE TABLE %s (id bigint, num integer, payload text)" % BULK_TABLE)
+        try:
+            for batch in self.batch_sizes:
+                rows = [(n, n % 1000, payload) for n in range(0, batch)]
+                lines = ["%d\t%d\t%s\n" % r for r in rows]
+                row_bytes = sum([len(l) for l in lines]) / float(batch)
+
+                loaded = 0
+                begin = time.time()
+                end = begin + timeout
+                while time.time() < end:
+                    load(cur, rows, lines, batch)
+                    loaded += batch
+                elapsed = time.time() - begin
+
+                rate = loaded / elapsed if elapsed else 0
+                best = max(best, rate)
+                self.reports.append("batch %6d: %9d rows/sec, %7.1f MB/sec" % (batch, rate, rate * row_bytes / MB))
+                cur.execute("TRUNCATE %s" % BULK_TABLE)
+        finally:
+            cur.execute("DROP TABLE IF EXISTS %s" % BULK_TABLE)
+        return int(best), minscore
+
+    def bulk_insert(self, timeout, minscore, chunk):
+        def load(cur, rows, lines, batch):
+            cur.execute("BEGIN")
+            for r in rows:
+                cur.execute("INSERT INTO %s (id, num, payload) VALUES (%%s, %%s, %%s)" % BULK_TABLE, r)
+            cur.execute("COMMIT")
+
+        rate, minscore = self._bulk(timeout, minscore, load)
+        return rate, minscore, "bulk load: row-at-a-time INSERT, BATCH per txn", "rows/sec"
+
+    def bulk_multirow_values(self, timeout, minscore, chunk):
+        queries = {}
+
+        def load(cur, rows, lines, batch):
+            if batch not in queries:
+                queries[batch] = ("INSERT INTO %s (id, num, payload) VALUES " % BULK_TABLE +
+                                  ",".join(["(%s, %s, %s)"] * batch),
+                                  [v for r in rows for v in r])
+            cur.execute(*queries[batch])
+
+        rate, minscore = self._bulk(timeout, minscore, load)
+        return rate, minscore, "bulk load: INSERT ... VALUES (...) x BATCH", "rows/sec"
+
+    def bulk_execute_values(self, timeout, minscore, chunk):
+        def load(cur, rows, lines, batch):
+            psycopg2.extras.execute_values(cur, "INSERT INTO %s (id, num, payload) VALUES %%s" % BULK_TABLE, rows,
+                                           page_size=batch)
+
+        rate, minscore = self._bulk(timeout, minscore, load)
+        return rate, minscore, "bulk load: execute_values(), page = BATCH", "rows/sec"
+
+    def bulk_copy(self, timeout, minscore, chunk):
+        def load(cur, rows, lines, batch):
+            cur.copy_expert("COPY %s (id, num, payload) FROM STDIN" % BULK_TABLE, CopyStream(lines, batch))
+
+        rate, minscore = self._bulk(timeout, minscore, load)
+        return rate, minscore, "bulk load: COPY FROM STDIN, BATCH rows per COPY", "rows/sec"
+
+    def _create_dataset(self, rows=DEF_DATASET_ROWS):
+        # pgbench-like accounts/branches tables, the accounts are loaded by COPY and indexed afterwards
+        cur = self.con.cursor()
+        tag = "pgs_bench rows=%d" % rows
+        if self.keep_dataset:
+            cur.execute("SELECT obj_description(to_regclass(%s), 'pg_class')", (ACCOUNTS_TABLE,))
+            if cur.fetchone()[0] == tag:
+                return range(1, rows + 1)
+
+        self._drop_dataset(force=True)
+        begin = time.time()
+        branches = max(1, rows // ACCOUNTS_PER_BRANCH)
+        cur.execute("CREATE TABLE %s (bid integer PRIMARY KEY, bname varchar(32))" % BRANCHES_TABLE)
+        cur.execute("INSERT INTO %s SELECT g, 'branch ' || g FROM generate_series(1, %d) g" %
+                    (BRANCHES_TABLE, branches))
+        cur.execute("CREATE TABLE %s (aid integer, bid integer, abalance integer, filler char(84))" % ACCOUNTS_TABLE)
+        lines = ("%d\t%d\t0\t\n" % (aid, 1 + (aid - 1) % branches) for aid in range(1, rows + 1))
+        cur.copy_expert("COPY %s (aid, bid, abalance, filler) FROM STDIN" % ACCOUNTS_TABLE, CopyStream(lines))
+        cur.execute("ALTER TABLE %s ADD PRIMARY KEY (aid)" % ACCOUNTS_TABLE)
+        # VACUUM sets the visibility map bits, otherwise index-only scans visit the heap
+        cur.execute("VACUUM ANALYZE %s" % BRANCHES_TABLE)
+        cur.execute("VACUUM ANALYZE %s" % ACCOUNTS_TABLE)
+        cur.execute("COMMENT ON TABLE %s IS '%s'" % (ACCOUNTS_TABLE, tag))
+        elapsed = time.time() - begin
+
+        cur.execute("SELECT pg_total_relation_size(%s)", (ACCOUNTS_TABLE,))
+        self.reports.append("dataset: %d accounts, %d MB, built in %.1f sec" %
+                            (rows, int(cur.fetchone()[0]) / MB, elapsed))
+        return range(1, rows + 1)
+
+    def _drop_dataset(self, force=False):
+        if self.keep_dataset and not force:
+            return
+        cur = self.con.cursor()
+        cur.execute("DROP TABLE IF EXISTS %s" % ACCOUNTS_TABLE)
+        cur.execute("DROP TABLE IF EXISTS %s" % BRANCHES_TABLE)
+
+    def _server_planning_share(self, sql, keys, samples=20):
+        # planning vs execution time reported by EXPLAIN ANALYZE
+        cur = self.con.cursor()
+        planning = execution = 0
+        for k in random.choices(keys, k=samples):
+            cur.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql % k)
+            plan = cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            planning += plan[0].get("Planning Time", 0)
+            execution += plan[0].get("Execution Time", 0)
+        if not planning + execution:
+            return None
+        return 100.0 * planning / (planning + execution)
+
+    def _protocol(self, timeout, minscore, chunk, sql):
+        if not minscore:
+            minscore = 10000
+        keys = self._create_dataset()
+        means = {}
+        rates = {}
+        try:
+            for mode in PROTOCOL_MODES:
+                rates[mode] = self._loop(timeout, KeyedQuery(sql, keys, mode), chunk)
+                total = self.total()
+                means[mode] = total.hist.mean()
+                p50, p99 = total.hist.percentiles((50, 99))
+                self.reports.append("%-8s: %7d ops/sec, latency (ms): mean %.3f, p50 %.3f, p99 %.3f" %
+                                    (mode, rates[mode], means[mode] / 1000.0, p50 / 1000.0, p99 / 1000.0))
+            self.results = []
+
+            if means["simple"]:
+                self.reports.append("client-observed parse/plan overhead: %.1f%% of a simple query latency" %
+                                    (100.0 * (means["simple"] - means["prepared"]) / means["simple"]))
+            try:
+                share = self._server_planning_share(sql, keys)
+                if share is not None:
+                    self.reports.append("server-reported planning time: %.1f%% of planning + execution" % share)
+            except psycopg2.Error as e:
+                logging.debug("EXPLAIN ANALYZE failed: %s" % str(e))
+        finally:
+            self._drop_dataset()
+
+        return rates["prepared"], minscore
+
+    def protocol_point_select(self, timeout, minscore, chunk):
+        rate, minscore = self._protocol(timeout, minscore, chunk,
+                                        "SELECT abalance FROM %s WHERE aid = %%s" % ACCOUNTS_TABLE)
+        return rate, minscore, "protocol test: PK lookup (score: prepared)", "selects/sec"
+
+    def protocol_join_select(self, timeout, minscore, chunk):
+        rate, minscore = self._protocol(timeout, minscore, chunk,
+                                        "SELECT a.abalance, b.bname FROM %s a JOIN %s b ON b.bid = a.bid "
+                                        "WHERE a.aid = %%s" % (ACCOUNTS_TABLE, BRANCHES_TABLE))
+        return rate, minscore, "protocol test: PK lookup + join (score: prepared)", "selects/sec"
+
+    def _io_counters(self):
+        # shared buffers hits and reads of the accounts table and its index
+        cur = self.con.cursor()
+        cur.execute("SELECT pg_stat_clear_snapshot()")
+        cur.execute("SELECT coalesce(heap_blks_hit, 0) + coalesce(idx_blks_hit, 0), "
+                    "coalesce(heap_blks_read, 0) + coalesce(idx_blks_read, 0) "
+                    "FROM pg_statio_user_tables WHERE relname = %s", (ACCOUNTS_TABLE,))
+        row = cur.fetchone()
+        return (int(row[0]), int(row[1])) if row else (0, 0)
+
+    def _setting_bytes(self, name):
+        cur = self.con.cursor()
+        cur.execute("SELECT setting::bigint * CASE WHEN unit ~ '^[0-9]' THEN pg_size_bytes(unit) "
+                    "WHEN unit <> '' THEN pg_size_bytes('1' || unit) ELSE 1 END "
+                    "FROM pg_settings WHERE name = %s", (name,))
+        return int(cur.fetchone()[0])
+
+    def _working_set_tiers(self, dataset_size, shared_buffers, cache_size):
+        # working set sizes (bytes) around shared_buffers and effective_cache_size, the full dataset is the last one
+        if self.working_sets:
+            tiers = [ws * MB for ws in self.working_sets]
+        else:
+            tiers = [shared_buffers // 4, shared_buffers * 2, cache_size * 2]
+        return sorted(set([t for t in tiers if 0 < t < dataset_size] + [dataset_size]))
+
+    def _warm_working_set(self, rows):
+        # read the working set heap and index pages through shared buffers (a seq scan would use a small ring)
+        cur = self.con.cursor()
+        begin = time.time()
+        cur.execute("SET enable_seqscan = off")
+        cur.execute("SET enable_bitmapscan = off")
+        try:
+            cur.execute("SELECT sum(abalance) FROM %s WHERE aid <= %d" % (ACCOUNTS_TABLE, rows))
+        finally:
+            cur.execute("RESET enable_seqscan")
+            cur.execute("RESET enable_bitmapscan")
+        return time.time() - begin
+
+    def read_scaling(self, timeout, minscore, chunk):
+        if not minscore:
+            minscore = 1000
+        rows = self.scale * ROWS_PER_SCALE
+        self._create_dataset(rows)
+        scores = []
+        try:
+            cur = self.con.cursor()
+            cur.execute("SELECT pg_total_relation_size(%s)", (ACCOUNTS_TABLE,))
+            dataset_size = int(cur.fetchone()[0])
+            shared_buffers = self._setting_bytes("shared_buffers")
+            cache_size = self._setting_bytes("effective_cache_size")
+
+            for size in self._working_set_tiers(dataset_size, shared_buffers, cache_size):
+                ws_rows = max(RANGE_ROWS, min(rows, int(rows * size / dataset_size)))
+                keys = range(1, ws_rows - RANGE_ROWS + 2)
+                if size <= shared_buffers:
+                    fits = "fits shared_buffers"
+                elif size <= cache_size:
+                    fits = "fits effective_cache_size"
+                else:
+                    fits = "exceeds effective_cache_size"
+                warmup = self._warm_working_set(ws_rows)
+                self.reports.append("working set %d MB (%s), %d accounts, warmed up in %.1f sec" %
+                                    (size / MB, fits, ws_rows, warmup))
+
+                tier = {}
+                for name, sql in READ_SCALING_QUERIES:
+                    hit, read = self._io_counters()
+                    tier[name] = self._loop(timeout, KeyedQuery(sql, keys, "prepared"), chunk)
+                    hit2, read2 = self._io_counters()
+                    total = self.total()
+                    p50, p99 = total.hist.percentiles((50, 99))
+                    blks = hit2 - hit + read2 - read
+                    self.reports.append("    %-10s: %7d ops/sec, latency (ms): p50 %.3f, p99 %.3f, "
+                                        "shared_buffers hit %5.1f%%" %
+                                        (name, tier[name], p50 / 1000.0, p99 / 1000.0,
+                                         100.0 * (hit2 - hit) / blks if blks else 100.0))
+                scores.append(tier["point"])
+            self.results = []
+
+            if scores[0]:
+                self.reports.append("cache cliff: point select rate at the full dataset is %.1f%% "
+                                    "of the smallest working set" % (100.0 * scores[-1] / scores[0]))
+        finally:
+            self._drop_dataset()
+
+        return scores[-1], minscore, "read scaling: scale %d, point/range/index-only (score: point, full dataset)" % \
+            self.scale, "selects/sec"
+
+    def failures_report(self):
+        total = self.total()
+        if not total.failures:
+            return "aborted transactions: none"
+        n = sum(total.failures.values())
+        return "aborted transactions: %s (%.2f%% of %d attempts)" % \
+            (", ".join(["%s %d" % (k, v) for k, v in sorted(total.failures.items())]),
+             100.0 * n / total.loops if total.loops else 0, total.loops)
+
+    def _committed(self, rate):
+        # the aborted attempts don't count in the score
+        total = self.total()
+        if not total.loops:
+            return rate
+        return int(rate * (total.loops - sum(total.failures.values())) / total.loops)
+
+    def _contention(self, timeout, minscore, chunk, query):
+        if not minscore:
+            minscore = 500
+        if not chunk:
+            chunk = 10
+        cur = self.con.cursor()
+        cur.execute("DROP TABLE IF EXISTS %s" % HOT_TABLE)
+        cur.execute("CREATE TABLE %s (id integer PRIMARY KEY, balance bigint)" % HOT_TABLE)
+        cur.execute("INSERT INTO %s SELECT g, 0 FROM generate_series(1, %d) g" % (HOT_TABLE, self.hot_rows))
+        try:
+            rate = self._committed(self._loop(timeout, query, chunk))
+            self.reports.append(self.failures_report())
+        finally:
+            cur.execute("DROP TABLE IF EXISTS %s" % HOT_TABLE)
+        return rate, minscore
+
+    def contention_hot_update(self, timeout, minscore, chunk):
+        query = ContendedQuery("BEGIN; " + TRANSFER_SQL, range(1, self.hot_rows + 1), 2)
+        rate, minscore = self._contention(timeout, minscore, chunk, query)
+        return rate, minscore, "contention: 2-row transfer over %d hot rows" % self.hot_rows, "txns/sec"
+
+    def contention_hot_update_rr(self, timeout, minscore, chunk):
+        query = ContendedQuery("BEGIN ISOLATION LEVEL REPEATABLE READ; " + TRANSFER_SQL,
+                               range(1, self.hot_rows + 1), 2)
+        rate, minscore = self._contention(timeout, minscore, chunk, query)
+        return rate, minscore, "contention: 2-row transfer over %d hot rows, RR" % self.hot_rows, "txns/sec"
+
+    def contention_advisory_lock(self, timeout, minscore, chunk):
+        query = ContendedQuery("BEGIN; SELECT pg_advisory_xact_lock(%%(k1)s); "
+                               "UPDATE %s SET balance = balance + 1 WHERE id = %%(k1)s; COMMIT" % HOT_TABLE,
+                               range(1, self.hot_rows + 1), 1)
+        rate, minscore = self._contention(timeout, minscore, chunk, query)
+        return rate, minscore, "contention: advisory lock + update of %d hot rows" % self.hot_rows, "txns/sec"
+
+    def _queue(self, timeout, minscore, chunk, lock):
+        # job queue: every transaction consumes the oldest job and enqueues a new one
+        if not minscore:
+            minscore = 500
+        if not chunk:
+            chunk = 10
+        cur = self.con.cursor()
+        cur.execute("DROP TABLE IF EXISTS %s" % QUEUE_TABLE)
+        cur.execute("CREATE TABLE %s (id bigserial PRIMARY KEY, payload text)" % QUEUE_TABLE)
+        cur.execute("INSERT INTO %s (payload) SELECT 'job ' || g FROM generate_series(1, %d) g" %
+                    (QUEUE_TABLE, QUEUE_JOBS))
+        try:
+            rate = self._committed(self._loop(timeout, ContendedQuery(DEQUEUE_SQL % lock), chunk))
+            self.reports.append(self.failures_report())
+        finally:
+            cur.execute("DROP TABLE IF EXISTS %s" % QUEUE_TABLE)
+        return rate, minscore
+
+    def contention_queue_for_update(self, timeout, minscore, chunk):
+        rate, minscore = self._queue(timeout, minscore, chunk, "FOR UPDATE")
+        return rate, minscore, "contention: job queue, SELECT ... FOR UPDATE", "jobs/sec"
+
+    def contention_queue_skip_locked(self, timeout, minscore, chunk):
+        rate, minscore = self._queue(timeout, minscore, chunk, "FOR UPDATE SKIP LOCKED")
+        return rate, minscore, "contention: job queue, SELECT ... FOR UPDATE SKIP LOCKED", "jobs/sec"
+
+    def _connect(self, timeout, minscore, chunk, method, sslmode=None):
+        if not minscore:
+            minscore = 200
+        if not chunk:
+            chunk = 10
+
+        endpoints = [("server", self.db)]
+        if self.pooler:
+            endpoints.append(("pooler", self.pooler))
+
+        score = 0
+        results = []
+        for name, db in endpoints:
+            rate = self._loop(timeout, ConnectOp(db, method, sslmode), chunk)
+            self.reports.append("%-6s %s: %6d connects/sec, latency (ms): %s" %
+                                (name, str(db), rate, format_latency(self.total().hist)))
+            if name == "server":
+                score = rate
+                results = self.results
+        self.results = results
+        return score, minscore
+
+    def connect_raw(self, timeout, minscore, chunk):
+        rate, minscore = self._connect(timeout, minscore, chunk, "raw", "disable")
+        return rate, minscore, "connection test: psycopg2.connect(), no SSL", "connects/sec"
+
+    def connect_raw_ssl(self, timeout, minscore, chunk):
+        rate, minscore = self._connect(timeout, minscore, chunk, "raw", "require")
+        return rate, minscore, "connection test: psycopg2.connect(), SSL", "connects/sec"
+
+    def connect_reconnect(self, timeout, minscore, chunk):
+        rate, minscore = self._connect(timeout, minscore, chunk, "reconnect")
+        return rate, minscore, "connection test: DBConnection.reconnect()", "connects/sec"
+
+    @staticmethod
+    def register_workload(workload):
+        def testcase(self, timeout, minscore, chunk):
+            if not minscore:
+                minscore = workload.minscore
+            cur = self.con.cursor()
+            if workload.setup:
+                cur.execute(workload.setup)
+            try:
+                rate = self._loop(timeout, workload, chunk)
+            finally:
+                if workload.teardown:
+                    cur.execute(workload.teardown)
+            return rate, minscore, workload.description, "txns/sec"
+
+        name = "workload_%s" % workload.name
+        setattr(PgBench, name, testcase)
+        if name not in TESTCASES:
+            TESTCASES.append(name)
+        return name
+
 
 ############# End of PostgreSQL benchmark code ###########
 
@@ -90,6 +1436,56 @@ def main():
     p = OptionParser(test_description)
     p.add_option("-v", "--verbose", action="store_true", help="enable verbose mode")
     p.add_option("-t", "--testtime", type=int, default=5, help="test time (sec), default is %default")
+    p.add_option("-c", "--clients", type=int, default=1,
+                 help="number of concurrent clients (connections), default is %default")
+    p.add_option("-j", "--jobs", type=int, default=1,
+                 help="number of worker processes the clients are spread across, default is %default")
+    p.add_option("-P", "--per-second", action="store_true",
+                 help="report latency percentiles for every second (or --interval)")
+    p.add_option("-i", "--interval", type=float, default=1.0,
+                 help="time series interval (sec) for --per-second and --timeseries, default is %default")
+    p.add_option("--timeseries", type="string",
+                 help="write per-interval throughput/latency samples to given file (CSV if *.csv, NDJSON otherwise)")
+    p.add_option("--timeseries-format", type="choice", choices=("csv", "ndjson"),
+                 help="time series file format: csv or ndjson (default: by file extension)")
+    p.add_option("--server-stats", action="store_true",
+                 help="add checkpointer/bgwriter, WAL and autovacuum activity sampled on a side connection "
+                      "to the time series")
+    p.add_option("--profile", action="store_true",
+                 help="profile the client with cProfile, report client CPU per operation and the hottest functions")
+    p.add_option("-R", "--rate", type=int, default=0,
+                 help="open-loop mode: start RATE operations/sec in total on a fixed schedule, "
+                      "latency is measured from the scheduled start (default: closed loop)")
+    p.add_option("-b", "--batch-sizes", type="string", default=DEF_BATCH_SIZES,
+                 help="comma separated list of batch sizes for bulk_* testcases, default is %default")
+    p.add_option("--row-size", type=int, default=DEF_ROW_SIZE,
+                 help="payload size in bytes of a row loaded by bulk_* testcases, default is %default")
+    p.add_option("-s", "--scale", type=int, default=DEF_SCALE,
+                 help="read_scaling dataset scale factor, %d accounts per unit, default is %%default" % ROWS_PER_SCALE)
+    p.add_option("--working-sets", type="string",
+                 help="comma separated list of read_scaling working set sizes (MB), the full dataset is always "
+                      "tested last (default: 1/4 and 2x shared_buffers, 2x effective_cache_size)")
+    p.add_option("--keep-dataset", action="store_true",
+                 help="don't drop the generated accounts dataset, reuse it by next runs of the same size")
+    p.add_option("--hot-rows", type=int, default=DEF_HOT_ROWS,
+                 help="number of rows updated concurrently by contention_* testcases, default is %default")
+    p.add_option("--pooler-host", type="string",
+                 help="connection pooler host, connect_* testcases are repeated against it for comparison")
+    p.add_option("--pooler-port", type=int, help="connection pooler port (default is --db-port)")
+    p.add_option("-w", "--workload", action="append", default=[],
+                 help="load testcase from given workload definition file (multiple options accepted)")
+    p.add_option("-T", "--testcase", action="append", default=[],
+                 help="run given testcase only (multiple options accepted)")
+    p.add_option("-l", "--list", action="store_true", help="list available testcases and exit")
+    p.add_option("-r", "--repeat", type=int, default=1, help="run every testcase given number of times, "
+                 "use >= 2 for --compare statistics, default is %default")
+    p.add_option("-o", "--save", type="string", help="save results with host/version/config fingerprints to JSON file")
+    p.add_option("-C", "--compare", type="string", metavar="BASELINE",
+                 help="compare results with given baseline JSON file, exit with error on significant regressions")
+    p.add_option("--alpha", type=float, default=0.05,
+                 help="significance level of the --compare t-test, default is %default")
+    p.add_option("--tolerance", type=float, default=2.0,
+                 help="ignore --compare score changes below given percent, default is %default")
 
     DB.add_options(p)
 
@@ -97,19 +1493,84 @@ def main():
 
     configure_logging(opts.verbose)
 
+    workloads = []
+    for fname in opts.workload:
+        try:
+            workloads.append(PgBench.register_workload(Workload(fname)))
+        except (ValueError, configparser.Error) as e:
+            p.error(str(e))
+
+    if opts.list:
+        print("\n".join(TESTCASES))
+        return
+
+    working_sets = None
+    if opts.working_sets:
+        try:
+            working_sets = [int(ws) for ws in opts.working_sets.split(",")]
+        except ValueError:
+            p.error("invalid --working-sets value: '%s'" % opts.working_sets)
+
+    testcases = opts.testcase or workloads or TESTCASES[0:2]
+    for testcase in testcases:
+        if testcase not in TESTCASES:
+            p.error("unknown testcase '%s', use --list to see available ones" % testcase)
+
+    baseline = None
+    if opts.compare:
+        try:
+            baseline = Baseline.load(opts.compare)
+        except (IOError, ValueError) as e:
+            p.error("can't load baseline: %s" % str(e))
+
     db = DB(opts)
     print("Connecting to %s ..." % str(db))
     con = db.connect()
-    pb = PgBench(con)
+    pooler = None
+    if opts.pooler_host or opts.pooler_port:
+        pooler = DB(db_host=opts.pooler_host or db.loc.db_host, db_port=opts.pooler_port or db.loc.db_port,
+                    db_name=db.loc.db_name, db_user=db.loc.db_user, db_pass=db.loc.db_pass, db_ssl=db.loc.db_ssl,
+                    autodiscovery=False)
+
+    timeseries = None
+    if opts.timeseries:
+        timeseries = TimeSeriesWriter(opts.timeseries, opts.timeseries_format, opts.server_stats)
+
+    pb = PgBench(con, db, clients=opts.clients, jobs=opts.jobs, rate=opts.rate,
+                 batch_sizes=[int(b) for b in opts.batch_sizes.split(",")], row_size=opts.row_size,
+                 pooler=pooler, interval=opts.interval, timeseries=timeseries,
+                 server_stats=bool(opts.timeseries and opts.server_stats), scale=opts.scale,
+                 working_sets=working_sets, keep_dataset=opts.keep_dataset, hot_rows=opts.hot_rows,
+                 profile=opts.profile)
+
+    results = Baseline()
+    results.collect(con, {"testtime": opts.testtime, "clients": opts.clients, "jobs": opts.jobs, "rate": opts.rate,
+                          "batch_sizes": opts.batch_sizes, "row_size": opts.row_size, "scale": opts.scale,
+                          "working_sets": opts.working_sets, "hot_rows": opts.hot_rows})
 
     statuses = []
 
-    for testcase in ["sequential_select", "sequential_commit"]:
-        status, msg = pb.test(testcase, timeout=opts.testtime)
-        statuses.append(status)
-        print(msg)
+    for testcase in testcases:
+        for n in range(0, opts.repeat):
+            status, msg = pb.test(testcase, timeout=opts.testtime, per_second=opts.per_second, run=n)
+            statuses.append(status)
+            results.add(testcase, pb.metrics, pb.summary())
+            print(msg)
+
+    if timeseries:
+        timeseries.close()
+
+    if opts.save:
+        results.save(opts.save)
+        print("\nResults saved to %s" % opts.save)
 
-    if False in statuses:
+    if baseline:
+        # the baseline comparison replaces the minimal score thresholds
+        report, regressions = results.compare(baseline, opts.alpha, opts.tolerance)
+        print("\n".join(report))
+        if regressions:
+            sys.exit(-1)
+    elif False in statuses:
         sys.exit(-1)
 
 
@@ -23,6 +23,13 @@ import threading
 import curses
 import traceback
 import copy
+import locale
+import mmap
+import json
+import zlib
+import struct
+import datetime
+from array import array
 
 try:
     from StringIO import StringIO  # for Python 2
@@ -33,6 +40,9 @@ except ImportError:
 KEY_LEFT = 68
 KEY_RIGHT = 67
 
+# replay mode keys and the number of snapshots to step
+REPLAY_KEYS = {',': -1, '.': 1, '<': -60, '>': 60, 'g': -sys.maxsize, 'G': sys.maxsize}
+
 USER_COL_NAME = 0
 USER_COL_WIDTH = 1
 USER_COL_TYPE = 2
@@ -53,10 +63,25 @@ user_cols_def = [
     ["IdxScan",   9, "int",   False, "scan/s", "idx_scan",      "number of index scans per second"],
     ["SeqScan",   9, "int",   False, "scan/s", "seq_scan",      "number of sequential scans per second"],
     ["SeqRows",   9, "int",   False, "row/s",  "seq_tup_read",  "number of rows per second fetched by seq scans"],
+    ["HeapRead",  9, "int",   False, "blk/s",  "heap_blks_read", "number of heap blocks per second read from disk"],
+    ["HeapHit",   9, "int",   False, "blk/s",  "heap_blks_hit", "number of heap blocks per second found in buffer cache"],
+    ["IdxRead",   8, "int",   False, "blk/s",  "idx_blks_read", "number of index blocks per second read from disk"],
+    ["ToastRead", 9, "int",   False, "blk/s",  "toast_blks_read", "number of TOAST blocks per second read from disk"],
+    ["Hit%",      6, "float", True,  "%",      "heap_blks_hit_pct", "heap buffer cache hit ratio (lifetime ratio if idle)"],
     ["Locks",     6, "int",   True,  "count",  "locks",         "number of processes waiting for lock"],
     ["Reltuples", 10, "int",   True,  "count", "reltuples",     "approximate number of rows in table"]
 ]
 
+# per-table I/O columns (pg_statio_user_tables) are wide, they are shown by --io option or when sorted by
+user_cols_io = ("HeapRead", "HeapHit", "IdxRead", "ToastRead", "Hit%")
+
+TABLE_COL_MIN_WIDTH = 8
+
+# columns computed as hit / (hit + read) ratio of the given columns deltas
+user_cols_ratio = {
+    "Hit%": ("HeapHit", "HeapRead"),
+}
+
 user_cols_select_query = """
 SELECT
     %s
@@ -109,10 +134,196 @@ FROM
             LEFT JOIN pg_namespace n ON n.oid = C.relnamespace
 
     ) L ON (L_relname = relname AND L_schemaname = U.schemaname)
+
+    LEFT JOIN (
+        SELECT
+            relid AS S_relid,
+            heap_blks_read,
+            heap_blks_hit,
+            idx_blks_read,
+            toast_blks_read,
+            case WHEN heap_blks_hit + heap_blks_read > 0
+            THEN
+                (100.0 * heap_blks_hit / (heap_blks_hit + heap_blks_read))::float
+            ELSE
+                0
+            END heap_blks_hit_pct
+        FROM
+            pg_statio_user_tables
+    ) S ON (S_relid = U.relid)
 """
 
 user_cols_select_query_for_schema = user_cols_select_query + "WHERE U.schemaname = '%s'"
 
+SPARK_CHARS = u" \u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588"
+SPARK_MAX_ROWS = 4096      # max number of tables with history, memory is SPARK_MAX_ROWS * length * 4 bytes
+SPARK_EVICT_TICKS = 60     # drop history of tables which have not been shown for that many refreshes
+
+
+REC_MAGIC = b"PGSTOP1\n"
+REC_INDEX_SUFFIX = ".idx"
+REC_INDEX_ENTRY = struct.Struct("<dQQ")  # snapshot time, data offset, data length
+
+
+class SnapshotRecorder:
+    """
+    Append-only recording of the raw per-tick query results.
+
+    The data file holds a header with the column names followed by zlib compressed JSON
+    snapshots, the <file>.idx file holds a fixed-size (time, offset, length) entry per snapshot.
+    The data is written before the index entry, so an interrupted recording is still readable.
+    """
+
+    def __init__(self, fname, cols):
+        self.fname = fname
+        exists = os.path.exists(fname) and os.path.getsize(fname) > 0
+        self.data = open(fname, "ab")
+        self.index = open(fname + REC_INDEX_SUFFIX, "ab")
+        if exists:
+            rec_cols = SnapshotPlayer(fname).cols
+            if rec_cols != cols:
+                raise RuntimeError("can't append to '%s', it was recorded with different columns" % fname)
+        else:
+            self.data.write(REC_MAGIC + json.dumps(cols).encode() + b"\n")
+            self.data.flush()
+
+    def write(self, t, rows):
+        buf = zlib.compress(json.dumps([list(r) for r in rows], default=float).encode())
+        offset = self.data.tell()
+        self.data.write(buf)
+        self.data.flush()
+        self.index.write(REC_INDEX_ENTRY.pack(t, offset, len(buf)))
+        self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class SnapshotPlayer:
+    """
+    Lazy reader of SnapshotRecorder files, both files are mmap-ed and only requested
+    snapshots get decompressed, so seeking is O(log N) regardless of the recording size.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.pos = 0
+
+        self._data_f = open(fname, "rb")
+        self._index_f = open(fname + REC_INDEX_SUFFIX, "rb")
+        self.data = mmap.mmap(self._data_f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[0:len(REC_MAGIC)] != REC_MAGIC:
+            raise RuntimeError("'%s' is not a pgs-top recording" % fname)
+        eol = self.data.find(b"\n", len(REC_MAGIC))
+        self.cols = json.loads(self.data[len(REC_MAGIC):eol].decode())
+
+        if os.path.getsize(fname + REC_INDEX_SUFFIX):
+            self.index = mmap.mmap(self._index_f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.index = b""
+        self.count = len(self.index) // REC_INDEX_ENTRY.size
+
+    def time(self, n):
+        return REC_INDEX_ENTRY.unpack_from(self.index, n * REC_INDEX_ENTRY.size)[0]
+
+    def read(self, n):
+        t, offset, length = REC_INDEX_ENTRY.unpack_from(self.index, n * REC_INDEX_ENTRY.size)
+        return t, json.loads(zlib.decompress(self.data[offset:offset + length]).decode())
+
+    def find(self, t):
+        # index of the first snapshot taken at or after the given time
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return min(lo, self.count - 1)
+
+
+class RateHistory:
+    """
+    Fixed-size ring buffers of recent rates for the tables shown on the screen.
+
+    All the buffers live in a single preallocated array of SPARK_MAX_ROWS * length floats,
+    tables get a slot when shown and lose it after SPARK_EVICT_TICKS refreshes off the screen
+    (or when the least recently shown table has to make room for a new one).
+    """
+
+    def __init__(self, length, max_rows=SPARK_MAX_ROWS, evict_ticks=SPARK_EVICT_TICKS):
+        self.length = length
+        self.max_rows = max_rows
+        self.evict_ticks = evict_ticks
+
+        self.values = array('f', [0.0]) * (length * max_rows)
+        self.pos = array('L', [0]) * max_rows
+        self.count = array('L', [0]) * max_rows
+        self.seen = array('L', [0]) * max_rows
+
+        self.tick = 0
+        self.col = None
+        self.reset()
+
+    def reset(self, col=None):
+        self.col = col
+        self.slots = {}
+        self.free = list(range(self.max_rows - 1, -1, -1))
+
+    def next_tick(self):
+        self.tick += 1
+        old = [k for k, slot in self.slots.items() if self.tick - self.seen[slot] > self.evict_ticks]
+        for key in old:
+            self.free.append(self.slots.pop(key))
+
+    def _alloc(self, key):
+        if not self.free:
+            lru = min(self.slots, key=lambda k: self.seen[self.slots[k]])
+            self.free.append(self.slots.pop(lru))
+        slot = self.free.pop()
+        self.pos[slot] = 0
+        self.count[slot] = 0
+        self.slots[key] = slot
+        return slot
+
+    def record(self, key, val):
+        slot = self.slots.get(key)
+        if slot is None:
+            return
+        self.values[slot * self.length + self.pos[slot]] = val
+        self.pos[slot] = (self.pos[slot] + 1) % self.length
+        if self.count[slot] < self.length:
+            self.count[slot] += 1
+
+    def touch(self, key, val):
+        # called for rows visible on the screen
+        if key not in self.slots:
+            self._alloc(key)
+            self.record(key, val)
+        self.seen[self.slots[key]] = self.tick
+
+    def get(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            return []
+        base = slot * self.length
+        n = self.count[slot]
+        start = (self.pos[slot] - n) % self.length
+        return [self.values[base + (start + i) % self.length] for i in range(0, n)]
+
+    def sparkline(self, key):
+        vals = self.get(key)
+        top = max(vals) if vals else 0
+        if top <= 0:
+            line = "".join([SPARK_CHARS[1] for v in vals])
+        else:
+            last = len(SPARK_CHARS) - 1
+            line = "".join([SPARK_CHARS[max(1, int(round(v * last / top)))] if v > 0 else SPARK_CHARS[1]
+                            for v in vals])
+        return line.rjust(self.length)
+
 
 class PgTop:
     def __init__(self):
@@ -125,6 +336,9 @@ class PgTop:
 
         self.mutex = threading.Lock()
         self.prev_time = 0
+        self.history = None
+        self.recorder = None
+        self.player = None
 
         if sys.stderr.isatty():
             sys.stderr = StringIO()
@@ -141,8 +355,17 @@ class PgTop:
 
         for col in user_cols_def:
 
+            if self.opts and col[USER_COL_NAME] in user_cols_io and \
+                    not self.opts.io and self.opts.sort not in user_cols_io:
+                continue
+
+            if self.player:
+                # show only the recorded columns
+                if col[USER_COL_SQL_NAME] not in self.player.cols:
+                    continue
+
             # hide dB if there is only one DB
-            if col[USER_COL_NAME].lower() == "db" and len(self.con) == 1:
+            elif col[USER_COL_NAME].lower() == "db" and len(self.con) == 1:
                 continue
 
             self.user_cols_meta.append(col)
@@ -153,10 +376,15 @@ class PgTop:
                 self.user_cols_sorted = n
 
     def init(self, scr, con, opts):
+        # the replay file is opened (and --replay-from is checked) by main() before curses starts
         self.scr = scr
         self.con = con
         self.opts = opts
         self.init_user_cols()
+        if opts.record:
+            self.recorder = SnapshotRecorder(opts.record, [c[USER_COL_SQL_NAME] for c in self.user_cols_meta])
+        if opts.history:
+            self.history = RateHistory(opts.history)
 
     def fetch_user_cols(self):
         cols = ", ".join([c[USER_COL_SQL_NAME] for c in self.user_cols_meta])
@@ -169,9 +397,61 @@ class PgTop:
             con.commit()
         return data
 
-    def update_user_cols_view(self):
-        self.user_cols_view_ctime = time.ctime()
-        sql_data = self.fetch_user_cols()
+    def fetch_snapshot(self):
+        if not self.player:
+            t = time.time()
+            data = self.fetch_user_cols()
+            if self.recorder:
+                self.recorder.write(t, data)
+            return t, data
+
+        n = self.player.pos
+        if n >= self.player.count - 1:
+            self.paused = 1  # end of the recording
+        n = min(n, self.player.count - 1)
+        self.player.pos = n + 1
+
+        t, rows = self.player.read(n)
+        idx = [self.player.cols.index(c[USER_COL_SQL_NAME]) for c in self.user_cols_meta]
+        return t, [[r[i] for i in idx] for r in rows]
+
+    def seek(self, shift):
+        if not self.player:
+            return
+        # the snapshot shown is player.pos - 1, the one before it is needed to calculate the rates
+        n = max(1, min(self.player.count - 1, self.player.pos - 1 + shift))
+        self.mutex.acquire()
+        try:
+            self.player.pos = n - 1
+            self.prev_time = 0
+            if self.history:
+                self.history.reset(self.history.col)
+            self.update_user_cols_view()
+            self.update_user_cols_view()
+        finally:
+            self.mutex.release()
+
+    def poll(self):
+        # called every --delay tick: the snapshot is taken (and recorded) even if paused,
+        # the pause freezes only the view
+        self.mutex.acquire()
+        try:
+            if self.player:
+                if self.paused:
+                    return
+                self.update_user_cols_view()
+            else:
+                snapshot = self.fetch_snapshot()
+                if self.paused:
+                    return
+                self.update_user_cols_view(snapshot)
+        finally:
+            self.mutex.release()
+        self.refresh()
+
+    def update_user_cols_view(self, snapshot=None):
+        t, sql_data = snapshot if snapshot else self.fetch_snapshot()
+        self.user_cols_view_ctime = time.ctime(t)
 
         total = [0] * len(self.user_cols_meta)
         total[0] = "Total"
@@ -182,6 +462,9 @@ class PgTop:
                     total[n] = ""
                 else:
                     total[n] += data[n] if data[n] else 0
+        for name, (hit, read) in user_cols_ratio.items():
+            if name in self.user_cols_hash:
+                total[self.user_cols_hash[name]] = self.get_ratio(total, hit, read) or 0
         sql_data = [total] + sql_data
 
         user_data = {}
@@ -190,12 +473,17 @@ class PgTop:
 
         if not self.prev_time:
             self.user_cols_data_prev = user_data
-            self.prev_time = time.time()
+            self.prev_time = t
             return None
 
         self.user_cols_view_data = []
 
-        t = time.time()
+        if self.history:
+            if self.history.col != self.user_cols_sorted:
+                self.history.reset(self.user_cols_sorted)
+            self.history.next_tick()
+        history = self.history and self.user_cols_meta[self.user_cols_sorted][USER_COL_TYPE] != "str"
+
         for data in sql_data:
             out = []
 
@@ -216,6 +504,12 @@ class PgTop:
                         self.user_cols_data_prev[table][n] else 0
                     out.append(new - old)
 
+            for name, (hit, read) in user_cols_ratio.items():
+                if name in self.user_cols_hash:
+                    ratio = self.get_ratio(out, hit, read)
+                    if ratio is not None:
+                        out[self.user_cols_hash[name]] = ratio
+
             for n in range(0, len(out)):
                 if self.user_cols_meta[n][USER_COL_METRIC].endswith("/s"):
                     if t - self.prev_time:
@@ -223,11 +517,23 @@ class PgTop:
                 if self.user_cols_meta[n][USER_COL_TYPE] == "int":
                     out[n] = round(out[n])
 
+            if history:
+                self.history.record(table, out[self.user_cols_sorted])
+
+            # the last hidden field is the full table name to look up the history
+            out.append(table)
             self.user_cols_view_data.append(out)
 
         self.user_cols_data_prev = user_data
         self.prev_time = t
 
+    def get_ratio(self, row, hit, read):
+        hit = float(row[self.user_cols_hash[hit]] or 0)
+        read = float(row[self.user_cols_hash[read]] or 0)
+        if not hit + read:
+            return None
+        return 100.0 * hit / (hit + read)
+
     def get_user_cols_view_data(self):
         return sorted(self.user_cols_view_data, key=lambda x:
                       (x[self.user_cols_sorted],
@@ -235,6 +541,10 @@ class PgTop:
                           x[self.user_cols_hash['Reltuples']]),
                       reverse=True)
 
+    def addstr(self, max_x, y, x, line):
+        # lines wider than the screen wrap and writing past the screen end fails, so clip them
+        self.scr.addstr(y, x, line[:max(0, max_x - x - 1)])
+
     def _refresh(self):
         if not self.scr or self.terminate:
             return
@@ -242,7 +552,11 @@ class PgTop:
 
         s = sum([c[1] + 1 for c in self.user_cols_meta])
         s -= self.user_cols_meta[0][USER_COL_WIDTH]
-        self.user_cols_meta[0][USER_COL_WIDTH] = max_x - s
+        # the sparkline column is dropped if it doesn't fit the screen
+        sparkline = self.history and max_x - s - self.history.length - 1 >= TABLE_COL_MIN_WIDTH
+        if sparkline:
+            s += self.history.length + 1
+        self.user_cols_meta[0][USER_COL_WIDTH] = max(TABLE_COL_MIN_WIDTH, max_x - s)
 
         fmt = []
         for c in self.user_cols_meta:
@@ -256,11 +570,16 @@ class PgTop:
         fmt_header = " ".join(["%%%ds" % c[USER_COL_WIDTH] for c in self.user_cols_meta])
 
         self.scr.erase()
-        self.scr.addstr(0, 0, "%s | Use: 'left' and 'right' keys - select sortable col; 'p' pause; 'q' quit; 'space' refresh"
-                        % self.user_cols_view_ctime)
+        if self.player:
+            self.addstr(max_x, 0, 0, "%s | REPLAY %d/%d | Use: ',' '.' - step; '<' '>' - jump 60 steps; 'g' 'G' - begin/end; "
+                            "'left' 'right' - sortable col; 'p' pause; 'q' quit"
+                            % (self.user_cols_view_ctime, self.player.pos, self.player.count))
+        else:
+            self.addstr(max_x, 0, 0, "%s | Use: 'left' and 'right' keys - select sortable col; 'p' pause; 'q' quit; 'space' refresh"
+                            % self.user_cols_view_ctime)
         if self.paused:
-            self.scr.addstr(0, 0, "PAUSED! ")
-        self.scr.addstr(1, 0, "=" * max_x)
+            self.addstr(max_x, 0, 0, "PAUSED! ")
+        self.addstr(max_x, 1, 0, "=" * max_x)
         columns = []
         metrics = []
 
@@ -272,23 +591,32 @@ class PgTop:
             else:
                 columns.append(c[USER_COL_NAME])
 
-        self.scr.addstr(2, 0, fmt_header % tuple(columns))
-        self.scr.addstr(3, 0, fmt_header % tuple(metrics))
+        if sparkline:
+            fmt_header += " %%%ds" % self.history.length
+            columns.append("History")
+            metrics.append(self.user_cols_meta[self.user_cols_sorted][USER_COL_METRIC])
+
+        self.addstr(max_x, 2, 0, fmt_header % tuple(columns))
+        self.addstr(max_x, 3, 0, fmt_header % tuple(metrics))
 
-        if not self.paused:
-            self.update_user_cols_view()
         view = self.get_user_cols_view_data()
 
         if view == None:
             return
 
-        self.scr.addstr(4, 0, "-" * max_x)
+        self.addstr(max_x, 4, 0, "-" * max_x)
         r = 4
+        history = self.history and self.user_cols_meta[self.user_cols_sorted][USER_COL_TYPE] != "str"
         for row in view:
             r += 1
             if r == max_y:
                 break
-            self.scr.addstr(r, 0, fmt_data % tuple(row))
+            line = fmt_data % tuple(row[:len(self.user_cols_meta)])
+            if history:
+                self.history.touch(row[-1], row[self.user_cols_sorted])
+                if sparkline:
+                    line += " " + self.history.sparkline(row[-1])
+            self.addstr(max_x, r, 0, line)
 
         self.scr.refresh()
 
@@ -314,6 +642,8 @@ class PgTop:
         elif key == ' ':
             if self.paused:
                 self.paused = 0
+        elif key in REPLAY_KEYS:
+            self.seek(REPLAY_KEYS[key])
         else:
             return
         self.refresh()
@@ -347,15 +677,41 @@ class PgTop:
         self.deinit()
 
 
+def parse_time(s):
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%H:%M:%S", "%H:%M"):
+        try:
+            t = datetime.datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+        if t.year == 1900:
+            t = datetime.datetime.combine(datetime.date.today(), t.time())
+        return time.mktime(t.timetuple())
+    raise ValueError("unsupported time format: '%s'" % s)
+
+
+def record_loop(pgt, con, opts):
+    # headless recording, used when stdout is not a terminal
+    pgt.init(None, con, opts)
+    remaining = opts.count if opts.count else -1
+    print("Recording snapshots to '%s' every %s sec, press Ctrl-C to stop..." % (opts.record, opts.delay))
+    try:
+        while remaining:
+            pgt.fetch_snapshot()
+            time.sleep(opts.delay)
+            remaining -= 1
+    except KeyboardInterrupt:
+        pass
+    pgt.recorder.close()
+
+
 def main_loop(pgt, delay, count):
     remaining = count if count else -1
 
     try:
-        pgt.refresh()
+        pgt.poll()
         time.sleep(delay)
         while remaining:
-            if not pgt.paused:
-                pgt.refresh()
+            pgt.poll()
             time.sleep(pgt.opts.delay)
             if pgt.terminate:
                 return
@@ -407,8 +763,17 @@ def main():
     p.add_option("-a", "--abs",     action="store_true", help="show absolute values, not rates")
     p.add_option("-s", "--sort",    type="choice", default="Write",
                  choices=tuple([c[USER_COL_NAME] for c in user_cols_def]), help="sort by given column (default is '%default')")
+    p.add_option("-i", "--io",      action="store_true",
+                 help="show per-table I/O columns (pg_statio_user_tables), they are shown anyway if sorted by one of them")
     p.add_option("-S", "--schema",  type="string",
                  help="take into account only given schema (default: all schemas)")
+    p.add_option("-H", "--history", type=int, default=16,
+                 help="number of recent sorted column values shown as sparkline, 0 - disable (default is %default)")
+    p.add_option("-w", "--record", type="string",
+                 help="append raw snapshots to given file (runs without UI if stdout is not a terminal)")
+    p.add_option("-r", "--replay", type="string", help="replay snapshots recorded by --record from given file")
+    p.add_option("--replay-from", type="string",
+                 help="start replay from given time ('[YYYY-MM-DD ]HH:MM[:SS]')")
 
     DB.add_options(p)
 
@@ -416,6 +781,32 @@ def main():
 
     configure_logging(opts.verbose)
 
+    replay_from = None
+    if opts.replay_from:
+        if not opts.replay:
+            p.error("--replay-from requires --replay")
+        try:
+            replay_from = parse_time(opts.replay_from)
+        except ValueError as e:
+            p.error("invalid --replay-from: %s" % str(e))
+
+    if opts.replay:
+        try:
+            pgt.player = SnapshotPlayer(opts.replay)
+        except (OSError, ValueError, RuntimeError) as e:
+            p.error("can't replay '%s': %s" % (opts.replay, str(e)))
+        if pgt.player.count < 2:
+            p.error("'%s' has too few snapshots to replay" % opts.replay)
+        if replay_from:
+            pgt.player.pos = pgt.player.find(replay_from)
+
+        locale.setlocale(locale.LC_ALL, '')
+        try:
+            curses.wrapper(pg_top, pgt, {}, opts)
+        except:
+            pgt.handle_exc()
+        return
+
     # FIXME: it can be good idea to have multiple DBs connection here
     dbs = [DB(opts)]
     con = {}
@@ -427,7 +818,10 @@ def main():
         except Exception as x:
             print("failed to connect: ", type(x), str(x))
 
-    if con:
+    if con and opts.record and not sys.stdout.isatty():
+        record_loop(pgt, con, opts)
+    elif con:
+        locale.setlocale(locale.LC_ALL, '')  # needed for sparkline unicode chars
         try:
             curses.wrapper(pg_top, pgt, con, opts)
         except:
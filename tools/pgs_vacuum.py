@@ -14,6 +14,8 @@ import os
 import sys
 import time
 import re
+import datetime
+import threading
 
 try:
     sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
@@ -41,30 +43,218 @@ def table_name_is_valid(s, search=re.compile(r'[^A-Za-z_]').search):
     return not bool(search(s))
 
 
-def vacuum(tables):
-    pattern = r'[^\.a-z0-9]'
-
-    print("Vacuuming, please wait (it is safe to kill it anytime) ...\n")
-
-    old_isolation_level = con.isolation_level
-    con.set_isolation_level(0)
+MB = 1024 * 1024
+DEF_RATE = 50               # MB/s of VACUUM FULL work expected until the first vacuums are measured
+PROGRESS_INTERVAL = 10      # sec
+
+
+class VacuumJob:
+    def __init__(self, schema, table, bloat_bytes, table_bytes, indexes_bytes):
+        self.schema = schema
+        self.table = table
+        self.name = "%s.%s" % (schema, table)
+        self.bloat_bytes = bloat_bytes
+        self.table_bytes = table_bytes
+        self.indexes_bytes = indexes_bytes
+        # VACUUM FULL reads the whole table, writes its live part and rebuilds the indexes
+        self.work_bytes = max(1, 2 * table_bytes - bloat_bytes + indexes_bytes)
+
+        self.pid = None
+        self.started = 0
+        self.elapsed = 0
+        self.reclaimed = 0
+        self.status = "pending"
+
+    def priority(self):
+        # expected reclaimed bytes per byte (i.e. per second) of work
+        return self.bloat_bytes / self.work_bytes
+
+
+class VacuumScheduler:
+    """
+    Runs up to 'workers' VACUUM FULL concurrently, every worker on its own connection,
+    the tables with more bloat reclaimed per second of work go first; with a deadline
+    the tables which can't finish in time (by the measured VACUUM FULL rate) are skipped
+    and the running vacuums are cancelled at the deadline
+    """
+
+    def __init__(self, db, con, jobs, workers=1, deadline=None, rate=DEF_RATE * MB):
+        self.db = db
+        self.con = con
+        self.pending = sorted(jobs, key=lambda j: -j.priority())
+        self.jobs = list(self.pending)
+        self.workers = max(1, workers)
+        self.deadline = deadline
+        self.rate = rate
+        self.lock = threading.Lock()
+
+    def log(self, msg):
+        with self.lock:
+            print("  [%s] %s" % (datetime.datetime.now().strftime("%H:%M:%S"), msg))
+            sys.stdout.flush()
 
-    try:
-        for table in tables:
+    def measured_rate(self):
+        # work bytes per second of a single vacuum measured on the finished ones, so it
+        # reflects the concurrency as well
+        done = [j for j in self.jobs if j.status == "done" and j.elapsed]
+        elapsed = sum([j.elapsed for j in done])
+        if elapsed < 1:
+            return self.rate
+        return sum([j.work_bytes for j in done]) / elapsed
+
+    def expected_time(self, job):
+        return job.work_bytes / self.measured_rate()
+
+    def time_left(self):
+        return self.deadline - time.time() if self.deadline else None
+
+    def _next(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return None
+                j = self.pending.pop(0)
+                left = self.time_left()
+                expected = self.expected_time(j)
+                if left is None or expected <= left:
+                    j.status = "running"
+                    j.started = time.time()
+                    return j
+                j.status = "skipped"
+            self.log("skipping '%s': expected %.0f sec, %.0f sec left" % (j.name, expected, max(0, left)))
+
+    def _error(self, msg):
+        raise RuntimeError(msg)
+
+    def _worker(self, n):
+        con = None
+        while True:
+            j = self._next()
+            if not j:
+                break
+            try:
+                if not con:
+                    con = self.db.connect(fatal_error_cb=self._error, reconnect_attempts=1)
+                j.pid = DB.execute_fetchval(con, "SELECT pg_backend_pid()")
+                self.log("#%d vacuuming '%s' (%1.f MB, bloat %1.f MB), expected %.0f sec" %
+                         (n, j.name, j.table_bytes / MB, j.bloat_bytes / MB, self.expected_time(j)))
+                left = self.time_left()
+                DB.execute(con, "SET statement_timeout = %d" % (max(1, left * 1000) if left is not None else 0))
+                DB.execute(con, "VACUUM FULL \"%s\".\"%s\"" % (j.schema, j.table))
+                j.elapsed = time.time() - j.started
+                size = DB.execute_fetchval(con, "SELECT pg_table_size('\"%s\".\"%s\"'::regclass)" % (j.schema, j.table))
+                j.reclaimed = max(0, j.table_bytes - int(size or 0))
+                j.status = "done"
+                self.log("#%d '%s' done in %.1f sec, reclaimed %1.f MB" % (n, j.name, j.elapsed, j.reclaimed / MB))
+            except Exception as e:
+                j.elapsed = time.time() - j.started
+                j.status = "failed"
+                self.log("#%d '%s' failed after %.1f sec: %s" % (n, j.name, j.elapsed, str(e).strip()))
+                if con:
+                    con.close()
+                con = None
+        if con:
+            con.close()
+
+    def _progress(self):
+        running = [j for j in self.jobs if j.status == "running"]
+        phases = {}
+        if running and self.db.vermajor_a >= 12:
+            try:
+                for pid, phase, scanned, total in DB.execute_fetchall(self.con, """
+                        SELECT pid, phase, heap_blks_scanned, heap_blks_total FROM pg_stat_progress_cluster"""):
+                    phases[pid] = "%s %d%%" % (phase, 100 * scanned / total) if total else phase
+            except Exception as e:
+                logging.debug("can't get the vacuum progress: %s" % str(e))
+
+        done = [j for j in self.jobs if j.status == "done"]
+        left = self.time_left()
+        self.log("progress: %d of %d done, %d failed, %d skipped, reclaimed %1.f MB, %s%s" %
+                 (len(done), len(self.jobs), len([j for j in self.jobs if j.status == "failed"]),
+                  len([j for j in self.jobs if j.status == "skipped"]), sum([j.reclaimed for j in done]) / MB,
+                  ("%.0f min left, " % (left / 60)) if left is not None else "",
+                  ", ".join(["'%s' %.0f sec%s" % (j.name, time.time() - j.started,
+                                                 (" (%s)" % phases[j.pid]) if j.pid in phases else "")
+                             for j in running]) or "nothing running"))
+
+    def cancel(self):
+        for j in self.jobs:
+            if j.status == "running" and j.pid:
+                DB.execute_fetchval(self.con, "SELECT pg_cancel_backend(%s)", j.pid)
+
+    def run(self):
+        threads = []
+        for n in range(0, min(self.workers, len(self.pending))):
+            t = threading.Thread(target=self._worker, args=(n + 1,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        started = time.time()
+        try:
+            while [t for t in threads if t.is_alive()]:
+                for t in threads:
+                    t.join(PROGRESS_INTERVAL / len(threads))
+                if time.time() - started >= PROGRESS_INTERVAL and [t for t in threads if t.is_alive()]:
+                    self._progress()
+                    started = time.time()
+        except KeyboardInterrupt:
+            print("")
+            self.log("interrupted, cancelling the running vacuums")
+            with self.lock:
+                self.pending = []
+            self.cancel()
+            for t in threads:
+                t.join()
+
+        done = [j for j in self.jobs if j.status == "done"]
+        return done
+
+
+def parse_deadline(s):
+    # HH:MM of today, or of tomorrow if it's passed already
+    now = datetime.datetime.now()
+    t = datetime.datetime.strptime(s, "%H:%M")
+    d = now.replace(hour=t.hour, minute=t.minute, second=0, microsecond=0)
+    if d <= now:
+        d += datetime.timedelta(days=1)
+    return time.mktime(d.timetuple())
+
+
+def vacuum(db, tables):
+    # tables: (schema or None for the search_path, table, bloat bytes) tuples
+    jobs = []
+    for schema, table, bloat_bytes in tables:
+        if not table_name_is_valid(table) or (schema and not table_name_is_valid(schema)):
+            print("  skipping table '%s' because it has invalid table name" % table)
+            continue
+        row = DB.execute_fetchone(con, """
+            SELECT n.nspname, pg_table_size(c.oid), pg_indexes_size(c.oid)
+              FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+             WHERE c.oid = to_regclass(%s)""", ('"%s"."%s"' % (schema, table)) if schema else ('"%s"' % table))
+        if not row:
+            print("  skipping table '%s' because it doesn't exist" % table)
+            continue
+        jobs.append(VacuumJob(row[0], table, bloat_bytes, row[1], row[2]))
+
+    if not jobs:
+        print("\nNothing to vacuum")
+        return
 
-            if not table_name_is_valid(table):
-                print("  skipping table '%s' because it has invalid table name" % table)
-                continue
+    deadline = parse_deadline(opts.deadline) if opts.deadline else None
+    scheduler = VacuumScheduler(db, con, jobs, opts.jobs, deadline, opts.rate * MB)
 
-            t = time.time()
-            print("  vacuuming '%s'..." % table, end="")
-            sys.stdout.flush()
-            DB.execute(con, "VACUUM FULL \"%s\"" % table)
-            print("done in %.1f sec" % (time.time() - t))
-    finally:
-        con.set_isolation_level(old_isolation_level)
+    print("Vacuuming %d table(s), %1.f MB of bloat, with %d worker(s)%s, please wait "
+          "(it is safe to kill it anytime) ...\n" %
+          (len(jobs), sum([j.bloat_bytes for j in jobs]) / MB, scheduler.workers,
+           (", deadline %s" % time.strftime("%Y-%m-%d %H:%M", time.localtime(deadline))) if deadline else ""))
 
-    print("\nDone")
+    t = time.time()
+    done = scheduler.run()
+    print("\nDone, %d of %d table(s) vacuumed in %.1f sec, reclaimed %1.f MB%s" %
+          (len(done), len(jobs), time.time() - t, sum([j.reclaimed for j in done]) / MB,
+           "".join([", %d %s" % (n, status) for n, status in
+                    [(len([j for j in jobs if j.status == x]), x) for x in ("skipped", "failed", "pending")] if n])))
 
 
 def pg_vacuum(db, con):
@@ -198,7 +388,7 @@ def pg_vacuum(db, con):
 
     q = """
     SELECT r.tablename, r.bloat_bytes, r.bloat_human, r.table_human, r.clear_table_human, r.bloat_perc, r.tbltuples,
-            r.last_vacuum, r.last_autovacuum, r.last_analyze, r.last_autoanalyze
+            r.last_vacuum, r.last_autovacuum, r.last_analyze, r.last_autoanalyze, r.schema
     FROM (%s) r
     WHERE bloat_perc >= {{BLOAT_PERC}}
     order by bloat_perc desc
@@ -228,7 +418,7 @@ def pg_vacuum(db, con):
         table_str = r[0]
         if len(table_str) > 32:
             table_str = table_str[0:32-3] + "..."
-        print("  %-32s %9s %8s %8s %6.1f %10s %16s %16s %16s %16s" % tuple([table_str] + list(r[2:])))
+        print("  %-32s %9s %8s %8s %6.1f %10s %16s %16s %16s %16s" % tuple([table_str] + list(r[2:11])))
 
     print("  -------------------------------- ---------")
     print("                 Total bloat size: %7dMB" % int(round(sum([r[1] for r in ret]) / (1024 * 1024), 0)))
@@ -258,12 +448,12 @@ def pg_vacuum(db, con):
                 return
 
             if ch == 'y':
-                selected.append(table)
+                selected.append((r[11], table, r[1]))
                 print("  scheduling '%s'" % table)
 
     if selected:
         print("")
-        vacuum(selected)
+        vacuum(db, selected)
     else:
         print("")
         print("Exiting, nothing to do")
@@ -281,7 +471,14 @@ def main():
     p.add_option("-a", "--vacuum", action="store_true", help="do the vacuuming")
     p.add_option("-m", "--bloat-mb", type="int", default=100, help="table bloat threshold in megabytes (default %default)")
     p.add_option("-p", "--bloat-perc", type="int", default=50, help="table bloat threshold in percent (default %default)")
-    p.add_option("-t", "--vacuum-table", action="append", help="vacuum given table and exit (multiple options accepted)")
+    p.add_option("-t", "--vacuum-table", action="append",
+                 help="vacuum given table (or schema.table) and exit (multiple options accepted)")
+    p.add_option("-j", "--jobs", type="int", default=1, help="number of concurrent vacuums (default %default)")
+    p.add_option("--deadline", type="string",
+                 help="maintenance window end, HH:MM: the tables which can't be vacuumed in time are skipped, "
+                      "the vacuums still running at the deadline are cancelled")
+    p.add_option("--rate", type="int", default=DEF_RATE,
+                 help="VACUUM FULL rate estimate in MB/s until the first vacuums are measured (default %default)")
 
     DB.add_options(p)
 
@@ -293,8 +490,14 @@ def main():
     print("Connecting to %s ..." % str(db))
     con = db.connect()
 
+    if opts.deadline:
+        try:
+            parse_deadline(opts.deadline)
+        except ValueError:
+            p.error("invalid --deadline '%s', HH:MM expected" % opts.deadline)
+
     if opts.vacuum_table and len(opts.vacuum_table):
-        vacuum(opts.vacuum_table)
+        vacuum(db, [tuple(t.split(".", 1)) + (0, ) if "." in t else (None, t, 0) for t in opts.vacuum_table])
         return
 
     pg_vacuum(db, con)
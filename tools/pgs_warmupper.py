@@ -6,8 +6,15 @@
 import os
 import sys
 import time
-import subprocess
+import mmap
+import ctypes
+import ctypes.util
 import datetime
+import itertools
+import threading
+import queue
+import json
+import psycopg2
 
 try:
     sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
@@ -26,142 +33,766 @@ import logging
 
 VERSION = '1.1'
 MB = 1024 * 1024
+GB = 1024 * MB
 RELWIDTH = 30
 
 
-def run(cmdline):
-    logging.debug("executing: %s" % cmdline)
-    p = subprocess.Popen(cmdline, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout_text, stderRText = p.communicate()
-    p.wait()
-    status = p.returncode
+WARMUP_BUF_SIZE = 8 * MB
+WARMUP_METHODS = ("read", "fadvise")
 
-    logging.debug("stdout: %s" % stdout_text)
-    if stderRText:
-        logging.debug("stderr: %s" % stderRText)
-    return (status, stdout_text, stderRText)
+
+RESIDENCY_CHUNK = MB        # granularity of the non-resident ranges
+DEF_RECHECK = 300
+
+
+class Residency:
+    """
+    Page cache residency of the files measured by mmap() + mincore(), the data isn't
+    read; the files are processed one (at most 1 GB) segment at a time, so the cost
+    is bounded by a page table walk and a 256 KB vector per segment
+    """
+
+    PROT_READ = 1
+    MAP_SHARED = 1
+    MAP_FAILED = ctypes.c_void_p(-1).value
+
+    def __init__(self):
+        self.libc = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            libc.mmap.restype = ctypes.c_void_p
+            libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                  ctypes.c_long]
+            libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+            libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+            self.libc = libc
+        except (OSError, AttributeError, TypeError) as e:
+            logging.warning("mincore() is not available, page cache residency can't be measured: %s" % str(e))
+
+        # only the least significant bit of a mincore() vector byte is defined
+        self.mask = bytes([b & 1 for b in range(0, 256)])
+
+    @property
+    def available(self):
+        return self.libc is not None
+
+    def measure(self, fname, chunk=RESIDENCY_CHUNK):
+        # returns (resident bytes, [(offset, length), ...] of the non-resident ranges)
+        fd = os.open(fname, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            if not size:
+                return 0, []
+            addr = self.libc.mmap(None, size, self.PROT_READ, self.MAP_SHARED, fd, 0)
+            if addr is None or addr == self.MAP_FAILED:
+                e = ctypes.get_errno()
+                raise OSError(e, "mmap: %s" % os.strerror(e))
+            try:
+                pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+                vec = (ctypes.c_ubyte * pages)()
+                if self.libc.mincore(addr, size, vec) != 0:
+                    e = ctypes.get_errno()
+                    raise OSError(e, "mincore: %s" % os.strerror(e))
+            finally:
+                self.libc.munmap(addr, size)
+        finally:
+            os.close(fd)
+
+        vec = bytes(vec).translate(self.mask)
+        resident = min(size, vec.count(1) * mmap.PAGESIZE)
+
+        missing = []
+        step = max(1, chunk // mmap.PAGESIZE)
+        for n in range(0, pages, step):
+            if 0 in vec[n:n + step]:
+                offset = n * mmap.PAGESIZE
+                if missing and missing[-1][0] + missing[-1][1] == offset:
+                    missing[-1] = (missing[-1][0], missing[-1][1] + step * mmap.PAGESIZE)
+                else:
+                    missing.append((offset, step * mmap.PAGESIZE))
+        if missing and missing[-1][0] + missing[-1][1] > size:
+            missing[-1] = (missing[-1][0], size - missing[-1][0])
+        return resident, missing
+
+
+class TokenBucket:
+    """
+    Global I/O bandwidth limit shared by the warmup workers: the consumers take
+    the tokens (bytes) in advance and sleep off the debt, bursts are up to 1 sec
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - n
+            self.last = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class FileWarmer:
+    """
+    Reads files into the OS page cache without spawning processes:
+        read    - sequential os.readv() into a reusable buffer, the data is in cache when it returns
+        fadvise - posix_fadvise(WILLNEED), the kernel reads the data in background
+    """
+
+    def __init__(self, method="read", buf_size=WARMUP_BUF_SIZE, bucket=None):
+        if method == "fadvise" and not hasattr(os, "posix_fadvise"):
+            logging.warning("posix_fadvise() is not supported, falling back to 'read' warmup method")
+            method = "read"
+        self.method = method
+        self.bucket = bucket
+        self.buf = bytearray(buf_size)
+        self.view = memoryview(self.buf)
+
+    def warm(self, fname, offset=0, length=None, progress=None):
+        # returns the number of bytes warmed up, progress(n) is called for every chunk read
+        fd = os.open(fname, os.O_RDONLY)
+        try:
+            end = os.fstat(fd).st_size
+            if length is not None:
+                end = min(end, offset + length)
+            if end <= offset:
+                return 0
+
+            if self.method == "fadvise":
+                # the kernel reads the range at the full device speed, so it can't be rate limited
+                os.posix_fadvise(fd, offset, end - offset, os.POSIX_FADV_WILLNEED)
+                if progress:
+                    progress(end - offset)
+                return end - offset
+
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, offset, end - offset, os.POSIX_FADV_SEQUENTIAL)
+            os.lseek(fd, offset, os.SEEK_SET)
+            pos = offset
+            while pos < end:
+                n = os.readv(fd, [self.view[0:min(len(self.buf), end - pos)]])
+                if n <= 0:
+                    break
+                pos += n
+                if self.bucket:
+                    self.bucket.consume(n)
+                if progress:
+                    progress(n)
+            return pos - offset
+        finally:
+            os.close(fd)
+
+
+HEAT_HALF_LIFE = 3600      # sec, the relations heat is the exponentially decayed amount of data read
+DEF_SAVE_INTERVAL = 300
+HOT_SET_VERSION = 2
+DEF_RESERVE_PCT = 10       # RAM reserved for the backends, OS and other processes by default
+
+
+def plan_knapsack(items, budget):
+    # 0/1 knapsack approximation over (value, size, item) tuples: greedy by value density,
+    # skipping the items which don't fit, or the single most valuable item if it's better
+    chosen = []
+    used = 0
+    for value, size, item in sorted(items, key=lambda x: -x[0] / max(1, x[1])):
+        if used + size <= budget:
+            chosen.append((value, size, item))
+            used += size
+    fitting = [x for x in items if x[1] <= budget]
+    if fitting:
+        best = max(fitting, key=lambda x: x[0])
+        if best[0] > sum([x[0] for x in chosen]):
+            chosen = [best]
+    return chosen
+
+
+def intersect_ranges(a, b):
+    # intersection of two sorted lists of non-overlapping [start, end) ranges
+    ret = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start = max(a[i][0], b[j][0])
+        end = min(a[i][1], b[j][1])
+        if start < end:
+            ret.append((start, end))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return ret
+
+
+def union_ranges(a, b):
+    # union of two sorted lists of non-overlapping [start, end) ranges
+    ret = []
+    for start, end in sorted(a + b):
+        if ret and ret[-1][1] >= start:
+            ret[-1] = (ret[-1][0], max(ret[-1][1], end))
+        else:
+            ret.append((start, end))
+    return ret
+
+
+def ranges_size(ranges):
+    return sum([end - start for start, end in ranges])
+
+
+SAMPLE_CHUNK = MB           # granularity of the sampled hot block ranges
+DEF_SAMPLE_INTERVAL = 60    # sec, pg_buffercache scan isn't free on large shared_buffers
+SAMPLE_MIN_HEAT = 0.5       # decayed usage count below which a chunk is forgotten
+PG_FORKS = {0: "main", 1: "fsm", 2: "vm", 3: "init"}
+
+
+class BlockSampler:
+    """
+    Block level heat of the relations sampled from pg_buffercache: the usage counts of the
+    shared buffers are summed up per SAMPLE_CHUNK of every relation fork and exponentially
+    decayed, the chunks which keep showing up are the hot ones, e.g. the recent tail of
+    append-mostly tables or the upper levels and the hot key ranges of B-tree indexes
+    """
+
+    def __init__(self, con, blk_size, interval=DEF_SAMPLE_INTERVAL):
+        self.con = con
+        self.chunk = max(1, SAMPLE_CHUNK // blk_size)
+        self.interval = interval
+        self.heat = {}  # (oid, fork) -> {chunk: decayed usage count}
+        self.sampled_at = 0
+
+    def sample(self):
+        # called by the poll thread, returns True if the sample has been taken
+        now = time.time()
+        if now - self.sampled_at < self.interval:
+            return False
+        rows = DB.execute_fetchall(self.con, """
+            SELECT pg_filenode_relation(reltablespace, relfilenode)::oid, relforknumber, chunk, usage
+              FROM (SELECT b.reltablespace, b.relfilenode, b.relforknumber,
+                           b.relblocknumber / %s AS chunk, sum(b.usagecount) AS usage
+                      FROM pg_buffercache b
+                     WHERE b.reldatabase = (SELECT oid FROM pg_database WHERE datname = current_database())
+                     GROUP BY 1, 2, 3, 4) s""", self.chunk)
+        self.con.commit()
+
+        if self.sampled_at:
+            decay = 0.5 ** ((now - self.sampled_at) / HEAT_HALF_LIFE)
+            for key, chunks in list(self.heat.items()):
+                for c in list(chunks):
+                    chunks[c] *= decay
+                    if chunks[c] < SAMPLE_MIN_HEAT:
+                        del chunks[c]
+                if not chunks:
+                    del self.heat[key]
+
+        for oid, fork, c, usage in rows:
+            if not oid or fork not in PG_FORKS:
+                continue
+            # keyed by the same integer oids as Relation.oids()
+            chunks = self.heat.setdefault((int(oid), PG_FORKS[fork]), {})
+            chunks[c] = chunks.get(c, 0) + int(usage or 0)
+        self.sampled_at = now
+        logging.debug("pg_buffercache sampled: %d chunks of %d relation forks" %
+                      (sum([len(x) for x in self.heat.values()]), len(self.heat)))
+        return True
+
+    def ranges(self, oids):
+        # {(oid, fork): [(first block, last block), ...]} of the hot chunks of the given relations
+        ret = {}
+        for oid, fork, chunks in self._chunks(oids):
+            lst = []
+            for c in sorted(chunks):
+                if lst and lst[-1][1] + 1 >= c * self.chunk:
+                    lst[-1] = (lst[-1][0], (c + 1) * self.chunk - 1)
+                else:
+                    lst.append((c * self.chunk, (c + 1) * self.chunk - 1))
+            ret[(oid, fork)] = lst
+        return ret
+
+    def size(self, oids, blk_size):
+        return sum([len(chunks) for oid, fork, chunks in self._chunks(oids)]) * self.chunk * blk_size
+
+    def _chunks(self, oids):
+        for oid in oids:
+            for fork in PG_FORKS.values():
+                chunks = self.heat.get((oid, fork))
+                if chunks:
+                    yield oid, fork, chunks
 
 
 class Relation:
+    """
+    A table or an index known by its oid, there can be millions of them, hence the slots;
+    the location (relfilenode and file paths of the relation, its TOAST relation and TOAST
+    index) is refreshed for all the relations at once by Warmupper.update_stats()
+    """
+    __slots__ = ("oid", "schema", "relname", "name", "size", "warmupper", "warmed_read", "warmed_at",
+                 "queued", "resident", "filenode", "toast_oids", "paths", "files", "blocks", "ranges",
+                 "disk_size", "done", "read_size", "read_size_delta", "heat", "heat_time", "seen")
+
     type = ""
 
-    def __init__(self, name, warmupper):
-        self.name = name.strip().strip("\"")
+    def __init__(self, oid, schema, relname, warmupper):
+        self.oid = oid
+        self.schema = schema
+        self.relname = relname
+        self.name = "%s.%s" % (schema, relname)
         self.size = 0
         self.warmupper = warmupper
 
-        self.warmed_up = False
+        # the data read since start at the last warmup queueing and the last warmup completion time,
+        # the relation is re-checked when it is read again (i.e. was evicted from the page cache)
+        self.warmed_read = 0
+        self.warmed_at = 0
+
+        # warmup state: set by the poll thread when queued, 'done' bytes are updated by the worker
+        self.queued = False
+        self.resident = 0
+        self.filenode = None
+        self.toast_oids = (None, None)
+        self.paths = (None, None, None)
+        self.files = []
+        self.blocks = []
+        self.ranges = None
+        self.disk_size = 0
+        self.done = 0
 
         self.read_size = 0
         self.read_size_delta = 0
+        self.heat = 0
+        self.heat_time = 0
+        self.seen = 0
+
+    def set_location(self, filenode, toast_oid, toast_index_oid, paths):
+        if self.filenode and filenode != self.filenode:
+            # rewritten by VACUUM FULL, CLUSTER, TRUNCATE..., the new files are cold
+            logging.debug("%s %s filenode changed %s -> %s" % (self.type, self.name, self.filenode, filenode))
+            if not self.queued:
+                self.warmed_read = 0
+                self.warmed_at = 0
+                self.ranges = None
+        self.filenode = filenode
+        self.toast_oids = (toast_oid, toast_index_oid)
+        self.paths = paths
+
+    def oids(self):
+        # the relation along with its TOAST relation and TOAST index
+        return [o for o in (self.oid,) + self.toast_oids if o]
 
     def update_stats(self, size, read_size):
         if size:
             self.size = size
         if self.read_size:
-            self.read_size_delta = read_size - self.read_size
+            delta = read_size - self.read_size
+            now = time.time()
+            self.heat = self.heat * 0.5 ** ((now - self.heat_time) / HEAT_HALF_LIFE) + \
+                max(0, delta - self.read_size_delta)
+            self.heat_time = now
+            self.read_size_delta = delta
         else:
             self.read_size = read_size
+            self.heat_time = time.time()
+
+    def get_files(self, targets):
+        # all the segments (relfilenode, relfilenode.1, ...) of the main fork and optionally of the
+        # visibility map and free space map forks of the given (oid, path) relations, as
+        # (file name, size, oid, fork, first block) tuples; the paths are relative to the data
+        # directory, tablespaces are reached via pg_tblspc symlinks
+        w = self.warmupper
+        files = []
+        for oid, path in targets:
+            if not path:
+                continue
+            base = os.path.join(w.data_dir, path)
+            for fork in w.forks_list():
+                segno = 0
+                while True:
+                    fname = base + ("_" + fork if fork != "main" else "") + (".%d" % segno if segno else "")
+                    try:
+                        files.append((fname, os.path.getsize(fname), oid, fork, segno * (w.seg_size // w.blk_size)))
+                    except OSError:
+                        break
+                    segno += 1
+        return files
+
+    def locate(self, sizes=None):
+        # returns (files, blocks): the relation files or its (oid, fork, size) list in the pg_prewarm
+        # mode taken from the 'sizes' fetched by Warmupper.fork_sizes() in bulk
+        files = []
+        blocks = []
+        if not self.filenode:
+            return files, blocks
+        if self.warmupper.prewarm:
+            for oid in self.oids():
+                for fork in self.warmupper.forks_list():
+                    size = (sizes or {}).get((oid, fork))
+                    if size:
+                        blocks.append((oid, fork, size))
+        elif self.warmupper.data_dir:
+            files = self.get_files(zip((self.oid,) + self.toast_oids, self.paths))
+        return files, blocks
+
+    def resolve(self, ranges=None, sizes=None, tail=0):
+        # called by the poll thread; 'ranges' limits the warmup to the given
+        # {(oid, fork): [(first block, last block), ...]} block ranges, 'tail' adds
+        # the last 'tail' bytes of every main fork
+        self.files, self.blocks = self.locate(sizes)
+        if tail:
+            ranges = dict(ranges or {})
+            for key, lst in self._tail_ranges(tail).items():
+                ret = union_ranges([(first, last + 1) for first, last in ranges.get(key, [])],
+                                   [(first, last + 1) for first, last in lst])
+                ranges[key] = [(start, end - 1) for start, end in ret]
+        self.ranges = ranges
+        if self.warmupper.prewarm:
+            self.disk_size = sum([ranges_size(self._block_ranges(oid, fork, size)) * self.warmupper.blk_size
+                                  for oid, fork, size in self.blocks])
+        elif self.files:
+            self.disk_size = sum([ranges_size(self._file_ranges(f)) for f in self.files])
+        else:
+            self.disk_size = self.size
+        self.done = 0
+        self.resident = 0
+
+    def _tail_ranges(self, tail):
+        # the last 'tail' bytes of the main forks and the other forks entirely
+        blk = self.warmupper.blk_size
+        nblocks = {}
+        for oid, fork, size in self.blocks:
+            nblocks[(oid, fork)] = (size + blk - 1) // blk
+        for fname, fsize, oid, fork, first_block in self.files:
+            nblocks[(oid, fork)] = max(nblocks.get((oid, fork), 0), first_block + (fsize + blk - 1) // blk)
+        ret = {}
+        for (oid, fork), n in nblocks.items():
+            if n:
+                ret[(oid, fork)] = [(max(0, n - tail // blk) if fork == "main" else 0, n - 1)]
+        return ret
 
-    def warmup(self):
-        if self.warmed_up:
-            return 0
-
-        if not self.size:
-            return 0
-
-        filenode = DB.execute_fetchval(self.warmupper.con, """
-            select cl.relfilenode
-            from pg_class cl
-                join pg_namespace nsp on cl.relnamespace = nsp.oid
-            WHERE cl.relname = '%s'""" % self.name)
-
-        if not filenode:
-            filenode = "unknown"
+    def _block_ranges(self, oid, fork, size):
+        # [first, last + 1) block ranges to warm up in the given fork
+        nblocks = (size + self.warmupper.blk_size - 1) // self.warmupper.blk_size
+        if self.ranges is None:
+            return [(0, nblocks)]
+        return intersect_ranges([(first, last + 1) for first, last in self.ranges.get((oid, fork), [])],
+                                [(0, nblocks)])
+
+    def _file_ranges(self, f):
+        # [start, end) byte ranges to warm up in the given segment file
+        fname, fsize, oid, fork, first_block = f
+        if self.ranges is None:
+            return [(0, fsize)]
+        blk = self.warmupper.blk_size
+        nblocks = (fsize + blk - 1) // blk
+        ret = intersect_ranges([(first, last + 1) for first, last in self.ranges.get((oid, fork), [])],
+                               [(first_block, first_block + nblocks)])
+        return [((start - first_block) * blk, min(fsize, (end - first_block) * blk)) for start, end in ret]
+
+    def resident_ranges(self, sizes=None):
+        # {(oid, fork): [(first block, last block), ...]} of the relation data in the page cache
+        # (or of all the data if the residency can't be measured), used by the hot set snapshots
+        files, blocks = self.locate(sizes)
+        blk = self.warmupper.blk_size
+        ranges = {}
+        for oid, fork, size in blocks:
+            ranges[(oid, fork)] = [(0, (size + blk - 1) // blk - 1)]
+        for fname, fsize, oid, fork, first_block in files:
+            resident = [(0, fsize)]
+            if self.warmupper.residency.available:
+                try:
+                    _, missing = self.warmupper.residency.measure(fname)
+                    resident = []
+                    pos = 0
+                    for offset, length in missing + [(fsize, 0)]:
+                        if offset > pos:
+                            resident.append((pos, offset))
+                        pos = offset + length
+                except OSError as e:
+                    logging.debug("can't measure %s residency: %s" % (fname, str(e)))
+            lst = ranges.setdefault((oid, fork), [])
+            for start, end in resident:
+                first, last = first_block + start // blk, first_block + (end - 1) // blk
+                if lst and lst[-1][1] + 1 >= first:
+                    lst[-1] = (lst[-1][0], last)
+                else:
+                    lst.append((first, last))
+        return dict([(k, v) for k, v in ranges.items() if v])
 
-        size = self.size
-        fname = None
+    def _progress(self, n):
+        self.done += n
 
-        if self.warmupper.data_dir:
-            _, fname, _ = run("find %s -name %s" % (self.warmupper.data_dir, filenode))
-            if fname:
-                fname = fname.strip()
-                if os.path.exists(fname):
-                    size = os.path.getsize(fname)
-                else:
-                    fname = None
+    def warmup(self, warmer):
+        # executed by a warmup worker, returns the number of bytes warmed up
+        rate_str = "-/-"
+        cached_str = "-/-"
+        ret = 0
+        error = False
+        t = time.time()
+
+        if self.warmupper.prewarm:
+            blk = self.warmupper.blk_size
+            for oid, fork, size in self.blocks:
+                if self.warmupper.dry_run:
+                    break
+                try:
+                    for first, end in self._block_ranges(oid, fork, size):
+                        ret += warmer.warm(oid, fork, first, end - 1, progress=self._progress)
+                except (RuntimeError, psycopg2.Error) as e:
+                    # e.g. no SELECT privilege or the relation has been truncated meanwhile
+                    logging.error("can't prewarm %s: %s" % (self.name, str(e).strip()))
+                    error = True
+        else:
+            residency = self.warmupper.residency
+            for f in self.files:
+                fname = f[0]
+                want = self._file_ranges(f)
+                if not want:
+                    continue
+                # only the ranges missing in the page cache are read
+                todo = want
+                if residency.available:
+                    try:
+                        _, missing = residency.measure(fname)
+                        todo = intersect_ranges(want, [(offset, offset + length) for offset, length in missing])
+                        resident = ranges_size(want) - ranges_size(todo)
+                        self.resident += resident
+                        self._progress(resident)
+                    except OSError as e:
+                        logging.debug("can't measure %s residency: %s" % (fname, str(e)))
+                if self.warmupper.dry_run:
+                    continue
+                try:
+                    for start, end in todo:
+                        ret += warmer.warm(fname, start, end - start, progress=self._progress)
+                except OSError as e:
+                    logging.error("can't warm up %s: %s" % (fname, str(e)))
+                    error = True
+            if self.files and residency.available and self.disk_size:
+                cached_str = "%d%%" % (100 * self.resident / self.disk_size)
+
+        if not self.files and not self.blocks:
+            time_str = "skipped"
+        elif self.warmupper.dry_run:
+            time_str = "dry run"
+        elif error:
+            time_str = "error"
+        else:
+            time_str = "%.1f" % (time.time() - t)
+        t = time.time() - t
+        if t and ret:
+            rate_str = "%.1f" % ((ret / MB) / t)
+
+        recheck = self.warmed_at
+        self.warmed_at = time.time()
+        self.queued = False
+        if recheck and not ret and time_str not in ("error", "skipped"):
+            logging.debug("%s is still in the page cache" % self.name)
+            return ret
 
         name = self.name
         if len(name) > RELWIDTH:
             name = name[0:RELWIDTH - 3] + "..."
 
-        print(self.warmupper.fmt1 %
-              (datetime.datetime.now().strftime("%m-%d %H:%M:%S"), self.type, name, filenode, self.read_size_delta / MB, size / MB), end="")
-        sys.stdout.flush()
-
-        rate_str = "-/-"
-        if fname:
-            if self.warmupper.dry_run:
-                time_str = "dry run"
-                ret = 0
-            else:
-                t = time.time()
-                run("dd if='%s' bs=8M of=/dev/null" % fname)
-                t = time.time() - t
-                time_str = "%.1f" % t
-                if t:
-                    rate_str = "%.1f" % ((size / MB) / t)
-                ret = size
-        else:
-            time_str = "skipped"
-            ret = 0
+        with self.warmupper.lock:
+            self.warmupper.total_warmed_size += ret
+            print((self.warmupper.fmt1 + self.warmupper.fmt2) %
+                  (datetime.datetime.now().strftime("%m-%d %H:%M:%S"), self.type, name, self.filenode or "unknown",
+                   "%.1f" % (self.read_size_delta / MB), "%.1f" % (self.disk_size / MB), cached_str, time_str,
+                   rate_str, "%1.f" % (self.warmupper.total_warmed_size / MB)))
+            sys.stdout.flush()
+        return ret
 
-        print(self.warmupper.fmt2 % (time_str, rate_str, "%1.f" % ((self.warmupper.total_warmed_size + ret) / MB)))
 
-        self.warmed_up = True
+PREWARM_MODES = ("prefetch", "read", "buffer")
+PREWARM_CHUNK = 16 * MB
+
+
+class PrewarmWarmer:
+    """
+    Warms relations up through the pg_prewarm extension over a per-worker connection:
+        prefetch - asynchronous OS readahead requests
+        read     - synchronous reads into the OS page cache
+        buffer   - reads into shared_buffers
+    Every call covers a PREWARM_CHUNK block range, so a backend is never busy for long
+    """
+
+    def __init__(self, db, mode, blk_size, bucket=None):
+        self.db = db
+        self.mode = mode
+        self.blk_size = blk_size
+        self.bucket = bucket
+        self.con = None
+
+    def _error(self, msg):
+        raise RuntimeError(msg)
+
+    def warm(self, oid, fork, first_block, last_block, progress=None):
+        # returns the number of bytes warmed up
+        if not self.con:
+            self.con = self.db.connect(fatal_error_cb=self._error, reconnect_attempts=1)
+        chunk = max(1, PREWARM_CHUNK // self.blk_size)
+        ret = 0
+        for first in range(first_block, last_block + 1, chunk):
+            last = min(last_block, first + chunk - 1)
+            if self.bucket:
+                self.bucket.consume((last - first + 1) * self.blk_size)
+            n = DB.execute_fetchval(self.con, "SELECT pg_prewarm(%s::oid, %s, %s, %s, %s)",
+                                    oid, self.mode, fork, first, last)
+            ret += int(n or 0) * self.blk_size
+            if progress:
+                progress((last - first + 1) * self.blk_size)
         return ret
 
 
-INDEXES = {}
+class WarmupPool:
+    """
+    Background warmup workers fed by a priority queue, the relations with more data
+    read since start go first, the I/O bandwidth is optionally capped by a token bucket
+    """
+
+    def __init__(self, workers, warmer_factory, max_rate=0):
+        self.queue = queue.PriorityQueue()
+        self.seq = itertools.count()
+        self.bucket = TokenBucket(max_rate) if max_rate else None
+        self.active = []
+        self.lock = threading.Lock()
+
+        for n in range(0, max(1, workers)):
+            t = threading.Thread(target=self._worker, args=(warmer_factory(self.bucket),))
+            t.daemon = True
+            t.start()
+
+    def put(self, relation, priority=None):
+        # the lower priority goes first
+        if relation.queued:
+            return
+        relation.queued = True
+        if priority is None:
+            priority = -relation.read_size_delta
+        self.queue.put((priority, next(self.seq), relation))
+
+    def _worker(self, warmer):
+        while True:
+            _, _, r = self.queue.get()
+            with self.lock:
+                self.active.append(r)
+            try:
+                r.warmup(warmer)
+            except Exception as e:
+                logging.error("%s warmup failed: %s" % (r.name, str(e)))
+                # not re-queued until the --recheck interval passes
+                r.warmed_at = time.time()
+                r.queued = False
+            finally:
+                with self.lock:
+                    self.active.remove(r)
+                self.queue.task_done()
+
+    def busy(self):
+        return self.queue.unfinished_tasks > 0
+
+    def progress(self):
+        with self.lock:
+            active = list(self.active)
+        done = sum([r.done for r in active])
+        total = sum([r.disk_size for r in active])
+        return "warming up %d relation(s): %1.f of %1.f MBytes (%d%%), %d queued" % \
+            (len(active), done / MB, total / MB, 100 * done / total if total else 0, self.queue.qsize())
+
+    def join(self, report_interval=None):
+        while self.busy():
+            if report_interval:
+                time.sleep(report_interval)
+                if self.busy():
+                    print(self.progress())
+            else:
+                self.queue.join()
 
 
 class Index(Relation):
-    type = "index"
+    __slots__ = ()
 
-    @staticmethod
-    def get(name, warmupper):
-        global INDEXES
-        if name not in INDEXES:
-            INDEXES[name] = Index(name, warmupper)
-        return INDEXES[name]
+    type = "index"
 
 
-TABLES = {}
+APPEND_MOSTLY_RATIO = 0.1    # updated and deleted rows per inserted row of an append-mostly table
 
 
 class Table(Relation):
+    __slots__ = ("indexes", "append_mostly")
+
     type = "table"
 
-    def __init__(self, name, warmupper):
-        Relation.__init__(self, name, warmupper)
+    def __init__(self, oid, schema, relname, warmupper):
+        Relation.__init__(self, oid, schema, relname, warmupper)
 
         self.indexes = {}
+        self.append_mostly = False
+
+    def update_activity(self, inserted, changed):
+        self.append_mostly = bool(inserted) and changed <= inserted * APPEND_MOSTLY_RATIO
 
-    def alloc_index(self, name, warmupper):
-        if name not in self.indexes:
-            self.indexes[name] = Index.get(name, warmupper)
-        return self.indexes[name]
 
-    @staticmethod
-    def get(name, warmupper):
-        global TABLES
-        if name not in TABLES:
-            TABLES[name] = Table(name, warmupper)
-        return TABLES[name]
+class RelationRegistry:
+    """
+    Tables and indexes keyed by oid, so the same named relations of different schemas
+    don't collide, and a dropped and re-created relation is a new one
+    """
+
+    def __init__(self, warmupper):
+        self.warmupper = warmupper
+        self.relations = {}
+        self.generation = 0
+
+    def get(self, cls, oid, schema, relname):
+        r = self.relations.get(oid)
+        if r is None or r.type != cls.type:
+            r = cls(oid, schema, relname, self.warmupper)
+            self.relations[oid] = r
+        elif r.relname != relname or r.schema != schema:
+            # renamed or moved to another schema, the files are the same
+            r.schema, r.relname, r.name = schema, relname, "%s.%s" % (schema, relname)
+        r.seen = self.generation
+        return r
+
+    def alloc_index(self, table, oid, schema, relname):
+        i = self.get(Index, oid, schema, relname)
+        table.indexes[oid] = i
+        return i
+
+    def begin(self):
+        self.generation += 1
+
+    def prune(self):
+        # forgets the relations dropped since the previous refresh, unless they are being warmed up
+        dropped = [oid for oid, r in self.relations.items() if r.seen != self.generation and not r.queued]
+        if not dropped:
+            return
+        for oid in dropped:
+            del self.relations[oid]
+        dropped = set(dropped)
+        for t in self.relations.values():
+            if isinstance(t, Table) and not dropped.isdisjoint(t.indexes):
+                t.indexes = dict([(oid, i) for oid, i in t.indexes.items() if oid not in dropped])
+
+    def values(self):
+        return list(self.relations.values())
+
+    def find(self, name):
+        # relations by 'schema.name' or by bare name in any schema
+        name = name.strip()
+        if "." in name:
+            schema, relname = [x.strip().strip("\"") for x in name.split(".", 1)]
+            return [r for r in self.relations.values() if r.schema == schema and r.relname == relname]
+        name = name.strip("\"")
+        return [r for r in self.relations.values() if r.relname == name]
 
 
 class Warmupper:
-    def __init__(self, con, warmup_threshold, dry_run, db_is_local):
+    def __init__(self, con, warmup_threshold, dry_run, db_is_local, method="read", forks=False, jobs=1,
+                 max_rate=0, recheck=DEF_RECHECK, db=None, prewarm=None, tail=0, sample=False,
+                 sample_interval=DEF_SAMPLE_INTERVAL):
         self.con = con
         self.warmup_threshold = warmup_threshold
         self.dry_run = dry_run
@@ -169,29 +800,55 @@ class Warmupper:
         self.warmed_tables = {}
         self.warmed_indexes = {}
         self.total_warmed_size = 0
+        self.total_planned_size = 0
+        self.forks = forks
         self._header_printed = False
+        self.lock = threading.Lock()
+        self.db = db
+        self.prewarm = prewarm
+        self.residency = Residency()
+        self.recheck = recheck
+        self.shared_buffers = 0
+        self.budget = None
+        self.plan_names = frozenset()
+        self.registry = RelationRegistry(self)
+        self.tail = tail
+        self.sampler = None
 
         self.blk_size = 0
+        self.seg_size = 0
         self.data_dir = ""
         self.total_size = 0
         self.tables_size = 0
         self.indexes_size = 0
 
         self.fmt1 = "%%14s %%-6s %%-%ds %%10s %%12s %%12s" % RELWIDTH
-        self.fmt2 = "%10s %10s %14s"
+        self.fmt2 = "%8s %10s %10s %14s"
 
         self.init()
 
+        if sample:
+            self.sampler = BlockSampler(con, self.blk_size, sample_interval)
+
+        if prewarm:
+            factory = lambda bucket: PrewarmWarmer(db, prewarm, self.blk_size, bucket)
+        else:
+            factory = lambda bucket: FileWarmer(method, bucket=bucket)
+        self.pool = WarmupPool(jobs, factory, max_rate)
+
     def init(self):
         self.blk_size = int(DB.execute_fetchval(self.con, "SHOW block_size"))
+        self.seg_size = int(DB.execute_fetchval(self.con, "SELECT pg_size_bytes(current_setting('segment_size'))"))
         try:
             self.data_dir = DB.execute_fetchval(self.con, "show data_directory")
         except Exception as e:
-            logging.error(e)
-            print("WARNING: forcing --dry-run mode, no actual warming up will be executed!!!")
             self.con.commit()
             self.data_dir = None
-            self.dry_run = True
+            # pg_prewarm works over SQL, the data directory isn't needed
+            if not self.prewarm:
+                logging.error(e)
+                print("WARNING: forcing --dry-run mode, no actual warming up will be executed!!!")
+                self.dry_run = True
 
         self.total_size, self.tables_size, self.indexes_size = DB.execute_fetchone(self.con, """
             SELECT
@@ -218,6 +875,12 @@ class Warmupper:
             ORDER BY total DESC
         ) s""")
 
+    def forks_list(self):
+        return ["main", "vm", "fsm"] if self.forks else ["main"]
+
+    def extension_available(self, name):
+        return DB.execute_fetchval(self.con, "SELECT count(*) FROM pg_extension WHERE extname = %s", name) > 0
+
     def get_ram_size(self):
         return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
 
@@ -228,56 +891,249 @@ class Warmupper:
         print("  Data directory:     %s" % self.data_dir)
         if self.db_is_local:
             print("  Total RAM size:     %1.f MBytes" % (self.get_ram_size() / MB))
+        print("  Shared buffers:     %1.f MBytes" % (self.shared_buffers / MB))
+        if self.budget is not None:
+            print("  Warmup budget:      %1.f MBytes" % (self.budget / MB))
         print("  Total DB size:      %1.f MBytes" % (self.total_size / MB))
         print("  - tables size:      %1.f MBytes" % (self.tables_size / MB))
         print("  - indexes size:     %1.f MBytes" % (self.indexes_size / MB))
         print("")
 
     def update_stats(self):
+        # the read stats along with the relfilenode and file paths of all the relations, their
+        # TOAST relations and TOAST indexes, one query per relation kind per poll cycle
+        self.registry.begin()
         rows = DB.execute_fetchall(self.con,
                                    """
-            SELECT relname,
-                   pg_relation_size(relid) table_size_bytes,
-                   heap_blks_read
-              FROM pg_statio_user_tables
-             where schemaname not like 'pg_temp%'
+            SELECT s.relid, s.schemaname, s.relname,
+                   pg_relation_size(s.relid) table_size_bytes,
+                   s.heap_blks_read,
+                   st.n_tup_ins, st.n_tup_upd + st.n_tup_del,
+                   cl.relfilenode, cl.reltoastrelid, ti.indexrelid,
+                   pg_relation_filepath(s.relid), pg_relation_filepath(cl.reltoastrelid),
+                   pg_relation_filepath(ti.indexrelid)
+              FROM pg_statio_user_tables s
+                   JOIN pg_stat_user_tables st ON st.relid = s.relid
+                   JOIN pg_class cl ON cl.oid = s.relid
+                   LEFT JOIN pg_index ti ON ti.indrelid = cl.reltoastrelid
+             where s.schemaname not like 'pg_temp%'
             """)
-        for table, table_size, read_size in rows:
-            t = Table.get(table, self)
-            t.update_stats(table_size, int(read_size) * self.blk_size)
+        for oid, schema, table, table_size, read_size, inserted, changed, filenode, toast_oid, toast_index_oid, \
+                filepath, toast_path, toast_index_path in rows:
+            t = self.registry.get(Table, oid, schema, table)
+            t.update_activity(inserted, changed)
+            t.set_location(filenode, toast_oid or None, toast_index_oid, (filepath, toast_path, toast_index_path))
+            t.update_stats(table_size, int(read_size or 0) * self.blk_size)
 
         rows = DB.execute_fetchall(self.con,
                                    """
-            SELECT relname,
-                   indexrelname,
-                   pg_relation_size(indexrelid) AS index_size_bytes,
-                   idx_blks_read
-              FROM pg_statio_user_indexes
-             where schemaname not like 'pg_temp%'
+            SELECT s.relid, s.indexrelid, s.schemaname, s.relname, s.indexrelname,
+                   pg_relation_size(s.indexrelid) AS index_size_bytes,
+                   s.idx_blks_read,
+                   cl.relfilenode, pg_relation_filepath(s.indexrelid)
+              FROM pg_statio_user_indexes s
+                   JOIN pg_class cl ON cl.oid = s.indexrelid
+             where s.schemaname not like 'pg_temp%'
             """)
 
-        for table, index, index_size, read_size in rows:
-            t = Table.get(table, self)
-            i = t.alloc_index(index, self)
-            i.update_stats(index_size, int(read_size) * self.blk_size)
+        for table_oid, oid, schema, table, index, index_size, read_size, filenode, filepath in rows:
+            t = self.registry.get(Table, table_oid, schema, table)
+            i = self.registry.alloc_index(t, oid, schema, index)
+            i.set_location(filenode, None, None, (filepath, None, None))
+            i.update_stats(index_size, int(read_size or 0) * self.blk_size)
 
         self.con.commit()
+        self.registry.prune()
 
-    def warmup(self, relations=None):
-        if not relations:
-            relations = []
-        _warmup = {}
+        if self.sampler and self.sampler.sample():
+            self.check_sample()
+
+    def check_sample(self):
+        # the sampled chunks must be keyed by the relations oids, or no relation would ever match
+        if not self.sampler.heat:
+            return
+        known = set()
+        for r in self.registry.values():
+            known.update(r.oids())
+        matched = len([1 for oid, fork in self.sampler.heat if oid in known])
+        if not matched:
+            logging.warning("none of %d sampled relation forks matches a known relation, the relations will be "
+                            "warmed up entirely" % len(self.sampler.heat))
+        else:
+            logging.debug("%d of %d sampled relation forks match known relations" % (matched, len(self.sampler.heat)))
+
+    def tail_size(self, r):
+        return self.tail if isinstance(r, Table) and r.append_mostly else 0
+
+    def hot_ranges(self, r):
+        # the sampled hot block ranges of the relation, None (everything) if it wasn't sampled
+        if not self.sampler:
+            return None
+        return self.sampler.ranges(r.oids()) or None
+
+    def warm_size(self, r):
+        # expected amount of data to warm up, used by the planner; a relation resolved to given
+        # block ranges (e.g. restored from the hot set) takes just their size
+        if r.ranges is not None:
+            return r.disk_size
+        size = max(r.size, r.disk_size)
+        parts = []
+        if self.sampler and self.hot_ranges(r):
+            parts.append(self.sampler.size(r.oids(), self.blk_size))
+        if self.tail_size(r):
+            parts.append(self.tail_size(r))
+        return min(size, sum(parts)) if parts else size
+
+    def fork_sizes(self, relations):
+        # {(oid, fork): size} of the given relations in one query, used by the pg_prewarm mode
+        oids = []
         for r in relations:
-            _warmup[r] = True
+            oids += r.oids()
+        if not oids:
+            return {}
+        rows = DB.execute_fetchall(self.con, """
+            select o, f, pg_relation_size(o, f)
+            from unnest(%s::oid[]) o, unnest(%s::text[]) f
+            where pg_relation_size(o, f) > 0""", oids, self.forks_list())
+        self.con.commit()
+        return dict([((o, f), size) for o, f, size in rows])
+
+    def init_budget(self, budget=None, reserve=None):
+        # memory available for the warmed up data: RAM minus shared_buffers minus the reserve,
+        # shared_buffers in the pg_prewarm 'buffer' mode; unknown for remote hosts
+        self.shared_buffers = int(DB.execute_fetchval(self.con,
+                                                      "SELECT pg_size_bytes(current_setting('shared_buffers'))"))
+        if budget:
+            self.budget = budget
+        elif self.prewarm == "buffer":
+            self.budget = self.shared_buffers
+        elif not self.prewarm or self.db_is_local:
+            ram = self.get_ram_size()
+            if reserve is None:
+                reserve = ram * DEF_RESERVE_PCT // 100
+            self.budget = max(0, ram - self.shared_buffers - reserve)
+        else:
+            self.budget = None
+
+    def plan(self, relations):
+        # the relations worth keeping in cache within the memory budget, ranked by heat density
+        # (data read per relation size); the plan is printed whenever it changes
+        if self.budget is None:
+            return relations
+        items = [(r.heat, self.warm_size(r), r) for r in relations if r.heat > 0]
+        chosen = plan_knapsack(items, self.budget)
+
+        names = frozenset([x[2].oid for x in chosen])
+        if names != self.plan_names:
+            self.plan_names = names
+            heat = sum([x[0] for x in items])
+            with self.lock:
+                print("Warmup plan: %d of %d hot relations, %1.f of %1.f MBytes budget, "
+                      "expected cache coverage %.1f%% of the data read" %
+                      (len(chosen), len(items), sum([x[1] for x in chosen]) / MB, self.budget / MB,
+                       100.0 * sum([x[0] for x in chosen]) / heat if heat else 0))
+        return [x[2] for x in chosen]
 
-        for t in TABLES.values():
-            if t.name in _warmup or t.read_size_delta >= self.warmup_threshold:
-                self.print_header()
-                self.total_warmed_size += t.warmup()
-        for i in INDEXES.values():
-            if i.name in _warmup or i.read_size_delta >= self.warmup_threshold:
-                self.print_header()
-                self.total_warmed_size += i.warmup()
+    def warmup(self, relations=None):
+        # queues the relations to the background workers, doesn't wait for the warmup;
+        # 'relations' are the names passed by -r option, 'schema.name' or just 'name'
+        _warmup = set()
+        for name in relations or []:
+            found = self.registry.find(name)
+            if not found:
+                logging.warning("relation %s not found" % name)
+            _warmup.update(found)
+
+        now = time.time()
+        candidates = self.registry.values()
+        planned = set(self.plan(candidates))
+        todo = []
+        for r in candidates:
+            if r.queued or not r.size:
+                continue
+            if r in _warmup:
+                if r.warmed_at:
+                    continue
+            elif r.read_size_delta - r.warmed_read < self.warmup_threshold or now - r.warmed_at < self.recheck:
+                continue
+            elif r not in planned:
+                continue
+            todo.append(r)
+
+        sizes = self.fork_sizes(todo) if self.prewarm and todo else None
+        for r in todo:
+            self.print_header()
+            r.warmed_read = r.read_size_delta
+            r.resolve(self.hot_ranges(r), sizes, self.tail_size(r))
+            self.total_planned_size += r.disk_size
+            self.pool.put(r)
+
+    def save_hot_set(self, fname):
+        # the relations being read with the block ranges of their data in the page cache, hottest first
+        relations = sorted([r for r in self.registry.values() if r.heat >= self.blk_size and r.filenode],
+                           key=lambda r: -r.heat)
+        sizes = self.fork_sizes(relations) if self.prewarm else None
+        entries = []
+        for r in relations:
+            ranges = r.resident_ranges(sizes)
+            if not ranges:
+                continue
+            entries.append({"oid": r.oid, "name": r.name, "type": r.type, "filenode": r.filenode,
+                            "heat": int(r.heat),
+                            "ranges": [[oid, fork, [list(x) for x in lst]] for (oid, fork), lst in ranges.items()]})
+
+        data = {"version": HOT_SET_VERSION, "saved": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "block_size": self.blk_size, "relations": entries}
+        tmp = fname + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, fname)
+        logging.debug("hot set of %d relations saved to %s" % (len(entries), fname))
+        return len(entries)
+
+    def restore_hot_set(self, fname):
+        # queues the saved hot set to the workers in heat order, returns the number of relations
+        with open(fname) as f:
+            data = json.load(f)
+        if data.get("version") != HOT_SET_VERSION or data.get("block_size") != self.blk_size:
+            raise ValueError("%s: unsupported hot set version or different block size" % fname)
+
+        self.update_stats()
+        found = []
+        for e in sorted(data["relations"], key=lambda e: -e["heat"]):
+            r = self.registry.relations.get(e["oid"])
+            if r is None or r.name != e["name"] or r.type != e["type"]:
+                # dropped and re-created, or restored from a dump: the saved oids are meaningless
+                r = [x for x in self.registry.find(e["name"]) if x.type == e["type"]]
+                if not r:
+                    logging.warning("%s %s doesn't exist anymore, skipped" % (e["type"], e["name"]))
+                    continue
+                r = r[0]
+                ranges = None
+            elif r.filenode != e["filenode"]:
+                # rewritten by VACUUM FULL, CLUSTER, TRUNCATE..., the saved block ranges are meaningless
+                logging.warning("%s %s has been rewritten, warming it up entirely" % (e["type"], e["name"]))
+                ranges = None
+            else:
+                ranges = dict([((oid, fork), [tuple(x) for x in lst]) for oid, fork, lst in e["ranges"]])
+            if r.queued:
+                continue
+            r.heat = e["heat"]
+            found.append((r, ranges))
+
+        sizes = self.fork_sizes([r for r, _ in found]) if self.prewarm else None
+        resolved = []
+        for r, ranges in found:
+            r.resolve(ranges, sizes)
+            resolved.append(r)
+
+        planned = set(self.plan(resolved))
+        self.print_header()
+        for r in resolved:
+            if r in planned:
+                self.total_planned_size += r.disk_size
+                self.pool.put(r, -r.heat)
+        return len(planned)
 
     def print_header(self):
         if self._header_printed:
@@ -286,15 +1142,15 @@ class Warmupper:
 
         self.print_sep_line("=")
         print(self.fmt1 % ("MM-DD HH:MM:SS", " TYPE ", "NAME", "FILENODE", "READ SINCE", " SIZE ON "), end="")
-        print(self.fmt2 % ("  WARMUP", " WARMUP", "TOTAL WARMED"))
+        print(self.fmt2 % ("CACHED", "  WARMUP", " WARMUP", "TOTAL WARMED"))
         print(self.fmt1 % ("              ", "      ", "    ", "        ", "START (MB)", "DISK (MB)"), end="")
-        print(self.fmt2 % ("TIME (s)", "   MB/s", "   SIZE (MB)"))
+        print(self.fmt2 % ("BEFORE", "TIME (s)", "   MB/s", "   SIZE (MB)"))
         self.print_sep_line()
 
     def print_sep_line(self, s="-"):
-        print(s * 127)
+        print(s * 136)
 
-    def loop(self, delay, count):
+    def loop(self, delay, count, save=None, save_interval=DEF_SAVE_INTERVAL):
 
         print("Started @ %s\n" % datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
@@ -304,9 +1160,16 @@ class Warmupper:
         if not count:
             count = -1
 
+        saved = time.time()
         while count:
             self.update_stats()
             self.warmup()
+            if self.pool.busy():
+                with self.lock:
+                    print(self.pool.progress())
+            if save and time.time() - saved >= save_interval:
+                self.save_hot_set(save)
+                saved = time.time()
             time.sleep(delay)
             if count > 0:
                 count -= 1
@@ -319,6 +1182,42 @@ def main():
     p.add_option("-n", "--count", type=int, default=0, help="exit after COUNT iterations")
     p.add_option("-r", "--relation", action="append", help="comma separated list of tables or indexes to warmup and exit")
     p.add_option("--dry-run", action="store_true", help="skip actual files warmup")
+    p.add_option("-s", "--save", type="string",
+                 help="periodically save the hot set (relations being read with their cached block ranges) to FILE")
+    p.add_option("--save-interval", type=int, default=DEF_SAVE_INTERVAL,
+                 help="hot set saving interval (sec), default is %default")
+    p.add_option("--restore", type="string",
+                 help="warm up the hot set saved by --save to FILE, hottest relations first, and exit")
+    p.add_option("--recheck", type=int, default=DEF_RECHECK,
+                 help="re-check the page cache residency of the warmed up relations being read again after "
+                      "given number of seconds and re-warm the evicted ranges (default is %default)")
+    p.add_option("-b", "--budget", type=int,
+                 help="memory budget for the warmed up data, MB (default: RAM - shared_buffers - reserve, or "
+                      "shared_buffers in the pg_prewarm 'buffer' mode)")
+    p.add_option("--reserve", type=int,
+                 help="RAM reserved for the backends, OS and other processes, MB (default: %d%% of RAM)" %
+                      DEF_RESERVE_PCT)
+    p.add_option("--sample", action="store_true",
+                 help="sample the shared buffers usage by pg_buffercache extension to find the hot block ranges of "
+                      "the relations and warm up only those")
+    p.add_option("--sample-interval", type=int, default=DEF_SAMPLE_INTERVAL,
+                 help="pg_buffercache sampling interval (sec), default is %default")
+    p.add_option("--tail", type=int, default=0,
+                 help="warm up only the last TAIL GBytes of append-mostly tables (rarely updated or deleted rows), "
+                      "plus the sampled hot ranges if --sample is given")
+    p.add_option("--forks", action="store_true",
+                 help="warmup visibility map and free space map forks too")
+    p.add_option("-j", "--jobs", type=int, default=1,
+                 help="number of parallel warmup workers, e.g. 1 for spinning disks, 8 for NVMe (default is %default)")
+    p.add_option("--max-rate", type=int, default=0,
+                 help="total warmup I/O bandwidth limit, MB/s (default: unlimited), forces the 'read' files "
+                      "warmup method")
+    p.add_option("-p", "--prewarm", type="choice", choices=PREWARM_MODES,
+                 help="warm up through the pg_prewarm extension over SQL connections instead of reading the files: "
+                      "'prefetch', 'read' (OS page cache) or 'buffer' (shared_buffers), works for remote servers")
+    p.add_option("-m", "--method", type="choice", choices=WARMUP_METHODS, default="read",
+                 help="files warmup method: 'read' (sequential reads) or 'fadvise' (asynchronous kernel "
+                      "readahead via posix_fadvise), default is %default")
     p.add_option("-t", "--threshold", type=int, default=1,
                  help="threshold of data read in MegaBytes to trigger warmup procedure (default is %default)")
 
@@ -338,23 +1237,55 @@ def main():
             for x in r.split(","):
                 relations.append(x)
 
-    w = Warmupper(con, opts.threshold * MB, opts.dry_run, opts.db_host == "127.0.0.1")
+    if opts.max_rate and opts.method == "fadvise":
+        # posix_fadvise() readahead runs at the full device speed, the rate is capped only for the reads
+        print("WARNING: --max-rate can't limit the 'fadvise' warmup method, using 'read' method instead")
+        opts.method = "read"
+
+    w = Warmupper(con, opts.threshold * MB, opts.dry_run, opts.db_host == "127.0.0.1", opts.method, opts.forks,
+                  opts.jobs, opts.max_rate * MB, opts.recheck, db, opts.prewarm, opts.tail * GB,
+                  opts.sample, opts.sample_interval)
 
+    for enabled, ext in ((opts.prewarm, "pg_prewarm"), (opts.sample, "pg_buffercache")):
+        if enabled and not w.extension_available(ext):
+            print("ERROR: %s extension is not installed, execute 'CREATE EXTENSION %s' first" % (ext, ext))
+            sys.exit(1)
+
+    w.init_budget(opts.budget * MB if opts.budget else None,
+                  opts.reserve * MB if opts.reserve is not None else None)
     w.print_db_summary()
 
     try:
-        if opts.relation:
-            print("Warming up the tables and indexes passed by -r option ...\n")
-            w.print_header()
-            w.update_stats()
-            w.warmup(relations)
+        if opts.relation or opts.restore:
+            t = time.time()
+            if opts.restore:
+                print("Warming up the hot set saved to %s ...\n" % opts.restore)
+                try:
+                    w.restore_hot_set(opts.restore)
+                except (IOError, ValueError, KeyError) as e:
+                    print("ERROR: can't restore the hot set: %s" % str(e))
+                    sys.exit(1)
+            else:
+                print("Warming up the tables and indexes passed by -r option ...\n")
+                w.print_header()
+                w.update_stats()
+                w.warmup(relations)
+            w.pool.join(opts.delay)
+            t = time.time() - t
             w.print_sep_line()
-            print("Done")
+            print("Done, %1.f of %1.f MBytes warmed up in %.1f sec%s" %
+                  (w.total_warmed_size / MB, w.total_planned_size / MB, t,
+                   " (%.1f MB/s)" % (w.total_warmed_size / MB / t) if t else ""))
         else:
-            w.loop(opts.delay, opts.count)
+            w.loop(opts.delay, opts.count, opts.save, opts.save_interval)
+            if opts.save:
+                w.save_hot_set(opts.save)
     except KeyboardInterrupt as e:
         print("")
         w.print_sep_line()
+        if opts.save and not opts.restore and not opts.relation:
+            print("Saving the hot set to %s ..." % opts.save)
+            w.save_hot_set(opts.save)
 
 
 if __name__ == "__main__":